@@ -0,0 +1,469 @@
+#!/usr/bin/env python
+"""
+Benchmarks for src/elo_sort.py
+
+    python -m benchmarks.bench__elo_sort recommend -s 1000 -s 10000
+"""
+
+from random import Random
+from statistics import NormalDist
+from time import perf_counter
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import tracemalloc
+
+import click
+import numpy as np
+
+from benchmarks.quality import kendall_tau
+from src import elo_sort, elo_sortd
+
+
+def build_league(size, rounds=3, seed=0):
+    """
+    League of size players, where everybody played rounds games against
+    random opponents, so no player is neglected.
+    """
+    rng = Random(seed)
+    league = elo_sort.League()
+    players = [f"player {index}" for index in range(size)]
+    league.add_players(players)
+    for _ in range(rounds):
+        rng.shuffle(players)
+        for white, black in zip(players[::2], players[1::2]):
+            league.add_result(white, rng.choice("<>"), black)
+    return league, players
+
+
+def timeit(function, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = perf_counter()
+        function()
+        timings.append(perf_counter() - start)
+    return min(timings)
+
+
+@click.group()
+def bench():
+    pass
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+@click.option("-t", "--top", "tops", type=int, multiple=True)
+@click.option("-r", "--repeat", type=int, default=3)
+@click.option("--rounds", type=int, default=3, help="games already played")
+def recommend(sizes, tops, repeat, rounds):
+    """Per-recommendation latency of League.recommended_match."""
+    sizes = sizes or (1_000, 10_000, 50_000)
+    tops = tops or (None, 10)
+    print(f"{'players':>8} {'top':>6} {'latency (ms)':>13}")
+    for size in sizes:
+        league, players = build_league(size, rounds)
+        for top in tops:
+            latency = timeit(
+                lambda: league.recommended_match(players=players, top=top), repeat
+            )
+            print(f"{size:>8} {str(top):>6} {latency * 1000:>13.2f}")
+
+
+def measure_memory(function):
+    tracemalloc.start()
+    result = function()
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return size, result
+
+
+def dict_league(players):
+    """The per-player dicts League used before the array storage"""
+    elos = {player: 1500.0 + index for index, player in enumerate(players)}
+    games = {player: 0 for player in players}
+    perfect_score_players = set(players)
+    return elos, games, perfect_score_players
+
+
+def array_league(players):
+    league = elo_sort.League()
+    league.add_players(players)
+    league._elos[: league.size] += np.arange(league.size)
+    return league
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+def memory(sizes):
+    """Bytes per player of League, names excluded, against plain dicts."""
+    sizes = sizes or (1_000, 10_000, 100_000)
+    print(f"{'players':>8} {'dicts (B)':>10} {'League (B)':>11}")
+    for size in sizes:
+        players = [f"player {index}" for index in range(size)]
+        dicts, _ = measure_memory(lambda: dict_league(players))
+        arrays, _ = measure_memory(lambda: array_league(players))
+        print(f"{size:>8} {dicts / size:>10.1f} {arrays / size:>11.1f}")
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+@click.option("-n", "--results", type=int, default=1000)
+def journal(sizes, results):
+    """Cost of recording a result and saving, against a full snapshot."""
+    sizes = sizes or (1_000, 10_000, 100_000)
+    print(f"{'players':>8} {'result+save (us)':>17} {'snapshot (ms)':>14}")
+    with tempfile.TemporaryDirectory() as folder:
+        elo_sort.LEAGUES_FOLDER = folder
+        for size in sizes:
+            league, players = build_league(size, rounds=0)
+            league.save(f"league {size}")
+            league = elo_sort.League.load(f"league {size}")
+            rng = Random(size)
+            start = perf_counter()
+            for _ in range(results):
+                white, black = rng.sample(players, 2)
+                league.add_result(white, ">", black)
+                league.save()
+            per_result = (perf_counter() - start) / results
+            snapshot = timeit(league.compact, 3)
+            league.close()
+            print(f"{size:>8} {per_result * 1e6:>17.1f} {snapshot * 1000:>14.2f}")
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+@click.option("-n", "--results", type=int, default=1000)
+def ranking(sizes, results):
+    """Cost of keeping the ranking index up to date, and of querying it."""
+    sizes = sizes or (1_000, 10_000, 100_000)
+    print(
+        f"{'players':>8} {'result (us)':>12} {'top 20 (us)':>12}"
+        f" {'rank of (us)':>13} {'full sort (ms)':>15}"
+    )
+    for size in sizes:
+        league, players = build_league(size)
+        league.top(20)
+        rng = Random(size)
+        pairs = [rng.sample(players, 2) for _ in range(results)]
+        start = perf_counter()
+        for white, black in pairs:
+            league.add_result(white, ">", black)
+        per_result = (perf_counter() - start) / results
+        top = timeit(lambda: league.top(20), 100)
+        rank_of = timeit(lambda: league.rank_of(players[0]), 100)
+        elos = league._elos[: league.size]
+        full_sort = timeit(lambda: np.argsort(-elos, kind="stable"), 10)
+        print(
+            f"{size:>8} {per_result * 1e6:>12.1f} {top * 1e6:>12.1f}"
+            f" {rank_of * 1e6:>13.1f} {full_sort * 1000:>15.2f}"
+        )
+
+
+@bench.command()
+@click.option("-n", "--pairs", type=int, default=100_000)
+@click.option("-d", "--distinct", type=int, default=10_000)
+def overlap(pairs, distinct):
+    """
+    ns per pair of each overlap kernel, with equal and mixed sigmas. The
+    scalar kernel is timed on pairs drawn from distinct different ones,
+    cold and then with its memo warm.
+    """
+    rng = np.random.default_rng(0)
+    mu_x = rng.uniform(1000, 2000, pairs)
+    mu_y = mu_x + rng.normal(0, 200, pairs)
+    sigma_x = rng.choice(800 / np.arange(2, 40), pairs)
+    repeated = rng.integers(0, distinct, pairs)
+    print(f"{'sigmas':>7} {'NormalDist':>11} {'overlap':>8} {'warm':>5} {'array':>6}")
+    for sigmas, sigma_y in (("equal", sigma_x), ("mixed", rng.permutation(sigma_x))):
+        columns = list(zip(mu_x.tolist(), sigma_x.tolist(), mu_y.tolist(), sigma_y))
+        columns = [columns[index] for index in repeated]
+        stdlib = timeit(
+            lambda: [
+                NormalDist(a, b).overlap(NormalDist(c, d)) for a, b, c, d in columns
+            ],
+            1,
+        )
+        elo_sort._overlap.cache_clear()
+        cold = timeit(lambda: [elo_sort.overlap(*column) for column in columns], 1)
+        warm = timeit(lambda: [elo_sort.overlap(*column) for column in columns], 1)
+        vectorized = timeit(
+            lambda: elo_sort.overlap_array(mu_x, sigma_x, mu_y, sigma_y), 3
+        )
+        print(
+            f"{sigmas:>7} {stdlib / pairs * 1e9:>11.0f} {cold / pairs * 1e9:>8.0f}"
+            f" {warm / pairs * 1e9:>5.0f} {vectorized / pairs * 1e9:>6.0f}"
+        )
+
+
+def sort_in_batches(truth, batch_size, target, budget, rng, backend="elo", top=None):
+    """
+    Play recommended matches between shuffled truth until the ranking is
+    target close to it, or with top until its first top players are those
+    of truth, in order. Returns comparisons, rounds and compute time.
+    """
+    players = list(truth)
+    rng.shuffle(players)
+    league = elo_sort.League(backend)
+    league.add_players(players)
+    position = {player: index for index, player in enumerate(truth)}
+    comparisons = rounds = 0
+    elapsed = 0
+    checkpoint = len(players) // 4
+    while comparisons < budget:
+        start = perf_counter()
+        try:
+            matches = league.recommended_matches(top=top or len(players), k=batch_size)
+        except RuntimeError:
+            break
+        for (white, black), _ in matches:
+            if position[white] < position[black]:
+                league.add_result(white, ">", black)
+            else:
+                league.add_result(white, "<", black)
+        league.end_period()
+        elapsed += perf_counter() - start
+        comparisons += len(matches)
+        rounds += 1
+        if top is not None:
+            if [player for _, player in league.top(top)] == truth[:top]:
+                break
+        elif comparisons >= checkpoint:
+            checkpoint += len(players) // 4
+            ranking = [player for _, player in league.get_ranking()]
+            if kendall_tau(ranking, truth) >= target:
+                break
+    return comparisons, rounds, elapsed
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+@click.option("-b", "--batch-size", "batch_sizes", type=int, multiple=True)
+@click.option("--target", type=float, default=0.9, help="Kendall tau to reach")
+@click.option("--latency", type=float, default=1.0, help="seconds per comparison")
+def batch(sizes, batch_sizes, target, latency):
+    """
+    Comparisons and time to reach the same Kendall tau with batched
+    recommendations, if each batch of comparisons is evaluated in parallel.
+    """
+    sizes = sizes or (100, 500)
+    batch_sizes = batch_sizes or (1, 4, 16)
+    print(
+        f"{'players':>8} {'batch':>6} {'comparisons':>12} {'rounds':>7}"
+        f" {'compute (s)':>12} {'wall-clock (s)':>15}"
+    )
+    for size in sizes:
+        truth = [f"player {index:06}" for index in range(size)]
+        budget = 20 * size * int(np.log2(size))
+        for batch_size in batch_sizes:
+            comparisons, rounds, elapsed = sort_in_batches(
+                truth, batch_size, target, budget, Random(size)
+            )
+            print(
+                f"{size:>8} {batch_size:>6} {comparisons:>12} {rounds:>7}"
+                f" {elapsed:>12.2f} {elapsed + rounds * latency:>15.1f}"
+            )
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+@click.option("-b", "--batch-size", "batch_sizes", type=int, multiple=True)
+@click.option("-t", "--top", type=int, default=10)
+@click.option("--target", type=float, default=0.9, help="Kendall tau to reach")
+def backends(sizes, batch_sizes, top, target):
+    """
+    Comparisons each rating backend needs to sort the same shuffled truth
+    to target Kendall tau, and to get its first top players right.
+    """
+    sizes = sizes or (100, 500)
+    batch_sizes = batch_sizes or (1, 8)
+    print(
+        f"{'players':>8} {'batch':>6} {'backend':>8} {'to tau':>7}"
+        f" {f'to top {top}':>9} {'compute (s)':>12}"
+    )
+    for size in sizes:
+        truth = [f"player {index:06}" for index in range(size)]
+        budget = 20 * size * int(np.log2(size))
+        for batch_size in batch_sizes:
+            for backend in elo_sort.BACKENDS:
+                to_tau, _, elapsed = sort_in_batches(
+                    truth, batch_size, target, budget, Random(size), backend
+                )
+                to_top, _, _ = sort_in_batches(
+                    truth, batch_size, target, budget, Random(size), backend, top
+                )
+                print(
+                    f"{size:>8} {batch_size:>6} {backend:>8} {to_tau:>7}"
+                    f" {to_top:>9} {elapsed:>12.2f}"
+                )
+
+
+@bench.command()
+@click.option("-s", "--size", type=int, default=1000)
+@click.option("-n", "--requests", type=int, default=1000)
+def server(size, requests):
+    """Round trips to elo_sortd, against starting a client process per call."""
+    with tempfile.TemporaryDirectory() as folder:
+        elo_sort.LEAGUES_FOLDER = folder
+        path = os.path.join(folder, "elo_sortd.sock")
+        league, players = build_league(size)
+        league.save("bench")
+        daemon = elo_sortd.make_server(path)
+        thread = threading.Thread(target=daemon.serve_forever)
+        thread.start()
+        rng = Random(size)
+        print(f"{'request':>22} {'latency (ms)':>13}")
+        try:
+            with elo_sortd.Client(path) as client:
+                calls = {
+                    "add_result": lambda: client.request(
+                        "add_result",
+                        league="bench",
+                        white=rng.choice(players),
+                        relation=">",
+                        black=rng.choice(players),
+                    ),
+                    "recommend": lambda: client.request(
+                        "recommend", league="bench", k=1, top=10
+                    ),
+                    "ranking (top 20)": lambda: client.request(
+                        "ranking", league="bench", n=20
+                    ),
+                }
+                for name, call in calls.items():
+                    start = perf_counter()
+                    for _ in range(requests):
+                        call()
+                    latency = (perf_counter() - start) / requests
+                    print(f"{name:>22} {latency * 1000:>13.3f}")
+
+            command = [sys.executable, elo_sortd.__file__, "ranking", "bench", "20"]
+            environment = {**os.environ, "ELO_SORTD_SOCKET": path}
+            client_process = timeit(
+                lambda: subprocess.run(
+                    command,
+                    env=environment,
+                    check=True,
+                    capture_output=True,
+                    stdin=subprocess.DEVNULL,
+                ),
+                5,
+            )
+            print(f"{'client process':>22} {client_process * 1000:>13.3f}")
+        finally:
+            daemon.shutdown()
+            daemon.server_close()
+            thread.join()
+
+        code = (
+            "import sys; from src import elo_sort;"
+            f"elo_sort.LEAGUES_FOLDER = {folder!r};"
+            "print(elo_sort.League.load('bench').top(20))"
+        )
+        standalone = timeit(
+            lambda: subprocess.run(
+                [sys.executable, "-c", code],
+                check=True,
+                capture_output=True,
+                stdin=subprocess.DEVNULL,
+            ),
+            5,
+        )
+        print(f"{'process, no server':>22} {standalone * 1000:>13.3f}")
+
+
+@bench.command()
+@click.option("-r", "--repeat", type=int, default=10)
+@click.option("--budget", type=float, default=0.5, help="seconds, best of repeat")
+def startup(repeat, budget):
+    """Cold start of a fresh python importing elo_sort, and of the CLI."""
+    deferred = ("click", "statistics", "concurrent.futures", "numpy.polynomial")
+    commands = {
+        "python": "pass",
+        "import numpy": "import numpy",
+        "import elo_sort": "from src import elo_sort",
+        "elo_sort --help": (
+            "import sys; from src import elo_sort;"
+            "sys.argv[1:] = ['--help']; elo_sort.main()"
+        ),
+    }
+    with tempfile.TemporaryDirectory() as home:
+        environment = {**os.environ, "HOME": home}
+        print(f"{'command':>16} {'seconds':>8}")
+        for name, code in commands.items():
+            seconds = timeit(
+                lambda: subprocess.run(
+                    [sys.executable, "-c", code],
+                    env=environment,
+                    check=True,
+                    capture_output=True,
+                    stdin=subprocess.DEVNULL,
+                ),
+                repeat,
+            )
+            print(f"{name:>16} {seconds:>8.3f}")
+        loaded = subprocess.run(
+            [
+                sys.executable,
+                "-c",
+                "import sys; from src import elo_sort;"
+                f"print(*(m for m in {deferred!r} if m in sys.modules))",
+            ],
+            env=environment,
+            check=True,
+            capture_output=True,
+            text=True,
+        ).stdout.split()
+        if os.listdir(home):
+            raise click.ClickException(f"import wrote to {home}: {os.listdir(home)}")
+    if loaded:
+        raise click.ClickException(f"imported at startup: {', '.join(loaded)}")
+    if seconds > budget:  # of the last command, the whole CLI
+        raise click.ClickException(f"{seconds:.3f}s over the {budget}s budget")
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+def columns(sizes):
+    """
+    Fresh process answering top 20 and a rank of from the pickled snapshot,
+    against the mmapped columns: seconds, and private and file backed RSS
+    grown past the imports (Linux only).
+    """
+    sizes = sizes or (10_000, 100_000, 1_000_000)
+    query = (
+        "import sys, time; from src import elo_sort;"
+        "status = lambda: dict(line.split(':') for line in open('/proc/self/status'));"
+        "rss = lambda: [int(status()[key].split()[0]) for key in ('RssAnon', 'RssFile')];"
+        "elo_sort.LEAGUES_FOLDER = sys.argv[1];"
+        "before = rss(); start = time.perf_counter();"
+        "league = elo_sort.{}('bench'); league.top(20); league.rank_of(sys.argv[2]);"
+        "print(time.perf_counter() - start, *map(int.__sub__, rss(), before))"
+    )
+    print(
+        f"{'players':>9} {'reader':>14} {'seconds':>8}"
+        f" {'private (MiB)':>14} {'mapped (MiB)':>13}"
+    )
+    with tempfile.TemporaryDirectory() as folder:
+        for size in sizes:
+            league, players = build_league(size, rounds=1)
+            elo_sort.LEAGUES_FOLDER = folder
+            league.save("bench")
+            for reader in ("League.load", "LeagueColumns.load"):
+                output = subprocess.run(
+                    [sys.executable, "-c", query.format(reader), folder, players[-1]],
+                    check=True,
+                    capture_output=True,
+                    text=True,
+                    stdin=subprocess.DEVNULL,
+                ).stdout
+                seconds, private, mapped = output.split()
+                print(
+                    f"{size:>9} {reader.split('.')[0]:>14} {float(seconds):>8.4f}"
+                    f" {int(private) / 1024:>14.1f} {int(mapped) / 1024:>13.1f}"
+                )
+
+
+if __name__ == "__main__":
+    bench()
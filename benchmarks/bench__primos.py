@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+"""
+Benchmarks for src/primos.py
+
+    python -m benchmarks.bench__primos cribar -n 1000000000
+"""
+
+from resource import RUSAGE_CHILDREN, RUSAGE_SELF, getrusage
+from tempfile import TemporaryDirectory
+from random import Random
+from time import perf_counter
+import filecmp
+import os
+
+import click
+
+from src import primos
+
+
+@click.group()
+def bench():
+    pass
+
+
+@bench.command()
+@click.option("-n", "--hasta", type=int, default=10**8)
+@click.option("-s", "--segmento", type=int, default=primos.SEGMENTO)
+@click.option("-j", "--procesos", type=int, default=1)
+@click.option("-p", "--partes", type=int, default=1, help="interrupted runs")
+def cribar(hasta, segmento, procesos, partes):
+    """
+    Time to sieve up to hasta in a fresh file, in partes resumed runs, and
+    the peak resident memory while sieving, of this process and of the
+    procesos workers. With procesos, the file is checked against the
+    serial sieve, once everything else is measured.
+    """
+    with TemporaryDirectory() as carpeta:
+        ruta = os.path.join(carpeta, "criba")
+        start = perf_counter()
+        for parte in range(1, partes + 1):
+            primos.cribar(hasta * parte // partes, ruta, segmento, procesos)
+        elapsed = perf_counter() - start
+        peak = getrusage(RUSAGE_SELF).ru_maxrss / 1024
+        workers_peak = getrusage(RUSAGE_CHILDREN).ru_maxrss / 1024
+        start = perf_counter()
+        cuantos = sum(1 for _ in primos.primos(0, hasta, ruta, segmento))
+        counting = perf_counter() - start
+        size = os.path.getsize(ruta)
+        numeros = Random(0).sample(range(hasta + 1), 10000)
+        start = perf_counter()
+        with primos.Tabla(ruta) as tabla:
+            opening = perf_counter() - start
+            start = perf_counter()
+            for numero in numeros:
+                tabla.es_primo(numero)
+            lookups = perf_counter() - start
+        if procesos > 1:
+            serie = os.path.join(carpeta, "serie")
+            primos.cribar(hasta, serie, segmento)
+            if not filecmp.cmp(ruta, serie, shallow=False):
+                raise click.ClickException("the serial sieve differs")
+    print(f"hasta={hasta} segmento={segmento} procesos={procesos} partes={partes}")
+    print(f"sieve {elapsed:.2f} s, {cuantos} primes read in {counting:.1f} s")
+    print(
+        f"open {opening * 1e6:.0f} us, 10000 random es_primo in {lookups * 1e3:.1f} ms"
+    )
+    print(
+        f"file {size / 2**20:.0f} MiB, peak memory while sieving {peak:.0f} MiB", end=""
+    )
+    print(f", {workers_peak:.0f} MiB per worker" if procesos > 1 else "")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,368 @@
+#!/usr/bin/env python
+"""
+Benchmarks for src/tstt_sort.py
+
+    python -m benchmarks.bench__tstt_sort ranking -m 100 -m 1000
+"""
+
+from itertools import combinations
+from random import Random
+from time import perf_counter, sleep
+import os
+
+import click
+
+from src import tstt_sort
+
+
+def build_league(size, matches, seed=0):
+    """League of size players and matches random results, better name wins"""
+    rng = Random(seed)
+    league = tstt_sort.TSTTLeague()
+    players = [f"player {index:05}" for index in range(size)]
+    league.add_players(players)
+    for _ in range(matches):
+        winner, loser = sorted(rng.sample(players, 2))
+        league.add_result(winner, loser)
+    return league, players
+
+
+@click.group()
+def bench():
+    pass
+
+
+@bench.command()
+@click.option("-m", "--matches", "match_counts", type=int, multiple=True)
+@click.option("-g", "--games", type=int, default=8, help="per player")
+@click.option("-n", "--new", type=int, default=10, help="matches timed")
+def ranking(match_counts, games, new):
+    """
+    get_ranked_players after each new match, converging the whole history
+    again against keeping it and sweeping the games of the new players.
+    Leagues grow with the matches, each player plays games of them.
+    """
+    match_counts = match_counts or (100, 400, 1600)
+    print(
+        f"{'matches':>8} {'players':>8} {'rebuild (ms)':>13} {'incremental (ms)':>17}"
+    )
+    for matches in match_counts:
+        size = max(2, 2 * matches // games)
+        league, players = build_league(size, matches)
+        league.get_ranked_players()
+        rng = Random(matches)
+        timings = {"rebuild": 0.0, "incremental": 0.0}
+        for _ in range(new):
+            winner, loser = sorted(rng.sample(players, 2))
+            league.add_result(winner, loser)
+            start = perf_counter()
+            league.get_ranked_players()
+            timings["incremental"] += perf_counter() - start
+            model, league.model = league.model, None
+            start = perf_counter()
+            league.get_ranked_players()
+            timings["rebuild"] += perf_counter() - start
+            league.model = model
+        print(
+            f"{matches:>8} {size:>8} {timings['rebuild'] / new * 1000:>13.1f}"
+            f" {timings['incremental'] / new * 1000:>17.1f}"
+        )
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+@click.option("-r", "--refine", type=int, default=5)
+@click.option("-e", "--exact-pairs", type=int, default=3, help="timed to estimate")
+def recommend(sizes, refine, exact_pairs):
+    """
+    recommend_pair latency with the approximate EVOI, refining its best
+    pairs, and the exact EVOI of every pair, estimated from a few of them.
+    Leagues have as many random matches as players.
+    """
+    sizes = sizes or (50, 200, 1000)
+    print(
+        f"{'players':>8} {'approximate (s)':>16} {f'refine {refine} (s)':>15}"
+        f" {'exact, estimated (s)':>21}"
+    )
+    for size in sizes:
+        league, players = build_league(size, size)
+        league.get_ranked_players()
+        start = perf_counter()
+        league.recommend_pair()
+        approximate = perf_counter() - start
+        start = perf_counter()
+        league.recommend_pair(refine=refine)
+        refined = perf_counter() - start
+        gaussians = league._gaussians()
+        pairs = [
+            tuple(sorted(Random(index).sample(players, 2)))
+            for index in range(exact_pairs)
+        ]
+        start = perf_counter()
+        league._exact_evois(pairs, gaussians)
+        exact = (perf_counter() - start) / exact_pairs * size * (size - 1) / 2
+        print(f"{size:>8} {approximate:>16.3f} {refined:>15.3f} {exact:>21.0f}")
+
+
+@bench.command()
+@click.option("-s", "--size", type=int, default=100)
+@click.option("-b", "--batch-size", "batch_sizes", type=int, multiple=True)
+@click.option("-l", "--latency", type=float, default=0.02, help="seconds per key")
+@click.option("-w", "--workers", type=int, default=16)
+def batch(size, batch_sizes, latency, workers):
+    """
+    sorted_tstt with a slow key, comparing batch_size pairs per round with
+    the keys computed by workers threads: wall time, and the fraction of
+    pairs of players the ranking orders right.
+    """
+    batch_sizes = batch_sizes or (1, 4, 16)
+    players = [f"player {index:05}" for index in range(size)]
+    Random(0).shuffle(players)
+
+    def key(player):
+        sleep(latency)
+        return player
+
+    print(f"{'batch':>6} {'seconds':>8} {'ordered':>8}")
+    for batch_size in batch_sizes:
+        start = perf_counter()
+        ranking = tstt_sort.sorted_tstt(
+            players, key=key, batch_size=batch_size, key_workers=workers
+        )
+        elapsed = perf_counter() - start
+        position = {player: index for index, player in enumerate(ranking)}
+        ordered = sum(
+            (position[left] < position[right]) == (left > right)
+            for left, right in combinations(players, 2)
+        ) / (size * (size - 1) / 2)
+        print(f"{batch_size:>6} {elapsed:>8.2f} {ordered:>8.1%}")
+
+
+@bench.command()
+@click.option("-s", "--size", type=int, default=100)
+@click.option("-c", "--confidence", type=float, default=0.9)
+@click.option("-t", "--threshold", type=float, default=0.5)
+@click.option("-k", "--top", type=int, default=10)
+@click.option("-l", "--limit", type=int, help="comparisons, N log N by default")
+def stopping(size, confidence, threshold, top, limit):
+    """
+    Comparisons sorted_tstt asks with each stopping rule, the fraction of
+    pairs of players ordered right, and of the true top players in the
+    first top positions, in order.
+    """
+    players = [f"player {index:05}" for index in range(size)]
+    Random(0).shuffle(players)
+    best = sorted(players, reverse=True)[:top]
+    print(f"{'rule':>24} {'compared':>9} {'ordered':>8} {f'top {top}':>7}")
+    for rule, options in (
+        ("N log N", {}),
+        (f"confidence {confidence}", {"confidence": confidence}),
+        (f"EVOI threshold {threshold}", {"threshold": threshold}),
+        (f"top {top}, {confidence}", {"confidence": confidence, "top": top}),
+    ):
+        calls = []
+
+        def key(player):
+            calls.append(player)
+            return player
+
+        ranking = tstt_sort.sorted_tstt(players, key=key, limit=limit, **options)
+        position = {player: index for index, player in enumerate(ranking)}
+        ordered = sum(
+            (position[left] < position[right]) == (left > right)
+            for left, right in combinations(players, 2)
+        ) / (size * (size - 1) / 2)
+        leading = sum(a == b for a, b in zip(ranking[:top], best)) / top
+        print(f"{rule:>24} {len(calls) // 2:>9} {ordered:>8.1%} {leading:>7.0%}")
+
+
+@bench.command()
+@click.option("-m", "--matches", type=int, default=100_000)
+@click.option("-g", "--games", type=int, default=8, help="per player")
+@click.option("-n", "--new", type=int, default=10, help="matches added after loading")
+def load(matches, games, new):
+    """
+    Time to load a league of matches stored matches, to rank it from the
+    stored posteriors, to unpickle its model and to catch up new matches.
+    The stored model is a forward pass only, converging it takes too long.
+    """
+    import tempfile
+
+    size = matches * 2 // games
+    league, players = build_league(size, matches)
+    with tempfile.TemporaryDirectory() as folder:
+        tstt_sort.LEAGUES_FOLDER = folder
+        start = perf_counter()
+        with tstt_sort.TSTTLeague.load("bench", create=True) as stored:
+            stored.add_players(players)
+            for winner, loser in league.matches:
+                stored.add_result(winner, loser)
+            stored.model = tstt_sort.IncrementalHistory(
+                [[[winner], [loser]] for winner, loser in league.matches],
+                [[1, 0]] * matches,
+                iterations=0,
+            )
+        print(
+            f"{matches} matches, {size} players, stored in {perf_counter() - start:.1f} s"
+        )
+        for suffix in ("matches", "model", "posteriors"):
+            path = os.path.join(folder, f"bench.{suffix}")
+            print(f"  {suffix:>10} {os.path.getsize(path) / 2**20:>8.1f} MiB")
+
+        start = perf_counter()
+        loaded = tstt_sort.TSTTLeague.load("bench")
+        timings = {"load": perf_counter() - start}
+        start = perf_counter()
+        loaded.get_ranked_players()
+        timings["rank from posteriors"] = perf_counter() - start
+        start = perf_counter()
+        loaded._update_model()
+        timings["unpickle model"] = perf_counter() - start
+        rng = Random(1)
+        start = perf_counter()
+        for _ in range(new):
+            loaded.add_result(*rng.sample(players, 2))
+        loaded.get_ranked_players()
+        timings[f"add {new} matches and rank"] = perf_counter() - start
+        loaded.close()
+        for name, seconds in timings.items():
+            print(f"{name:>26} {seconds:>8.3f} s")
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+@click.option("-g", "--games", type=int, default=4, help="per player")
+@click.option("-b", "--band", type=float, default=0.05)
+@click.option("-k", "--neighbours", type=int, default=8)
+def prune(sizes, games, band, neighbours):
+    """
+    recommend_pair latency and pairs pruned with the uncertainty band and
+    the nearest neighbours, and whether they still pick the unpruned pair.
+    """
+    sizes = sizes or (200, 1000, 3000)
+    print(
+        f"{'players':>8} {'filter':>14} {'pruned':>8} {'seconds':>8}"
+        f" {'same pair':>10}"
+    )
+    for size in sizes:
+        league, _ = build_league(size, size * games // 2)
+        league.get_ranked_players()
+        reports = []
+        league.on_prune = lambda pruned, total: reports.append(pruned / total)
+        best = None
+        for name, options in (
+            ("none", {}),
+            (f"band {band}", {"band": band}),
+            (f"{neighbours} nearest", {"neighbours": neighbours}),
+        ):
+            start = perf_counter()
+            pair = league.recommend_pair(**options)
+            elapsed = perf_counter() - start
+            best = best or pair
+            print(
+                f"{size:>8} {name:>14} {reports[-1]:>8.1%} {elapsed:>8.3f}"
+                f" {str(pair == best):>10}"
+            )
+
+
+@bench.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+def table(sizes):
+    """
+    Ranking, total variance, win probability matrix and recommend_pair on
+    the posterior arrays alone, with random posteriors.
+    """
+    import numpy as np
+
+    sizes = sizes or (1000, 3000)
+    print(
+        f"{'players':>8} {'rank (s)':>9} {'variance (s)':>13} {'matrix (s)':>11}"
+        f" {'recommend (s)':>14}"
+    )
+    for size in sizes:
+        league = tstt_sort.TSTTLeague()
+        league.add_players(f"player {index:05}" for index in range(size))
+        rng = np.random.default_rng(0)
+        league.mus = rng.normal(0, 3, size)
+        league.sigmas = rng.uniform(0.5, 6, size)
+        timings = []
+        for operation in (
+            league.get_ranked_players,
+            league.total_variance,
+            league.win_probabilities,
+            league.recommend_pair,
+        ):
+            start = perf_counter()
+            operation()
+            timings.append(perf_counter() - start)
+        print(
+            f"{size:>8} {timings[0]:>9.4f} {timings[1]:>13.6f} {timings[2]:>11.3f}"
+            f" {timings[3]:>14.3f}"
+        )
+
+
+@bench.command()
+@click.option("-s", "--size", type=int, default=12)
+@click.option("-m", "--matches", type=int, default=20)
+@click.option("-l", "--leagues", type=int, default=20)
+@click.option("-r", "--refine", type=int, default=5)
+def agreement(size, matches, leagues, refine):
+    """
+    How often the approximate EVOI picks the pair the exact one would, and
+    how much exact EVOI its pick gives up, over random leagues.
+    """
+    same = within = refined_same = 0
+    captured = []
+    for seed in range(leagues):
+        league, _ = build_league(size, matches, seed)
+        gaussians = league._gaussians()
+        pairs = list(combinations(gaussians, 2))
+        exact = dict(zip(pairs, league._exact_evois(pairs, gaussians)))
+        ranked = sorted(
+            exact,
+            key=lambda pair: -tstt_sort.approximate_evoi(
+                *gaussians[pair[0]], *gaussians[pair[1]]
+            ),
+        )
+        best = max(exact, key=exact.get)
+        same += ranked[0] == best
+        within += best in ranked[:refine]
+        refined_same += max(ranked[:refine], key=exact.get) == best
+        captured.append(exact[ranked[0]] / exact[best])
+    print(f"{leagues} leagues of {size} players and {matches} matches")
+    print(f"approximate pick is the exact pick: {same / leagues:.0%}")
+    print(f"exact pick among the best {refine} approximate: {within / leagues:.0%}")
+    print(f"refined pick is the exact pick: {refined_same / leagues:.0%}")
+    print(
+        f"exact EVOI of the approximate pick: {sum(captured) / leagues:.1%} of the best"
+    )
+
+
+@bench.command()
+@click.option("-s", "--size", type=int, default=50)
+@click.option("-r", "--refine", type=int, default=64)
+@click.option("-w", "--workers", "worker_counts", type=int, multiple=True)
+def parallel(size, refine, worker_counts):
+    """
+    recommend_pair refining refine pairs exactly, serially and in process
+    pools of workers processes, which must recommend the same pair.
+    """
+    worker_counts = worker_counts or sorted({1, 2, 4, os.cpu_count() or 1})
+    league, _ = build_league(size, size)
+    start = perf_counter()
+    serial = league.recommend_pair(refine=refine)
+    elapsed = perf_counter() - start
+    print(f"{os.cpu_count()} cores, {size} players, refining {refine} pairs")
+    print(f"{'workers':>8} {'seconds':>8} {'speedup':>8}")
+    print(f"{'serial':>8} {elapsed:>8.2f} {1:>8.2f}")
+    for workers in worker_counts:
+        start = perf_counter()
+        pair = league.recommend_pair(refine=refine, workers=workers)
+        seconds = perf_counter() - start
+        if pair != serial:
+            raise click.ClickException(f"{workers} workers recommended {pair}")
+        print(f"{workers:>8} {seconds:>8.2f} {elapsed / seconds:>8.2f}")
+
+
+if __name__ == "__main__":
+    bench()
@@ -0,0 +1,330 @@
+#!/usr/bin/env python
+"""
+How elo_sorted and sorted_tstt trade comparisons for accuracy.
+
+Players are sorted against a synthetic ground truth: player i has score i,
+observed by the key with gaussian noise, and the result is scored with
+Kendall tau and top-k precision against the noiseless order. Every run is a
+JSON record, so results from different versions can be compared.
+
+    python -m benchmarks.quality -s 100 -s 1000 --noise 0 --noise 5 -o run.json
+    python -m benchmarks.quality -s 100 -e elo -e tstt --target-tau 0.9
+
+Recorded comparisons, one "winner<TAB>loser" line each, are replayed into a
+league of each engine with --replay, and its ranking scored against the
+order by fraction of games won.
+"""
+
+from collections import Counter
+from contextlib import redirect_stdout
+from datetime import datetime, timezone
+from itertools import product
+from math import log
+from random import Random
+from time import perf_counter, process_time
+import io
+import json
+import platform
+import subprocess
+import sys
+import tempfile
+import tracemalloc
+
+import click
+
+from src import elo_sort, tstt_sort
+
+
+def synthetic(size, noise, seed=0):
+    """
+    Players best first, and a key that observes their rank with gaussian
+    noise of noise positions.
+    """
+    rng = Random(seed)
+    truth = [f"player {index:07}" for index in range(size)]
+    observed = {
+        player: index + rng.gauss(0, noise) for index, player in enumerate(truth)
+    }
+    return truth, observed.__getitem__
+
+
+def kendall_tau(ranking, truth):
+    """Kendall tau between two orderings of the same players, O(N log N)"""
+    position = {player: index for index, player in enumerate(truth)}
+    size = len(ranking)
+    tree = [0] * (size + 1)  # Fenwick tree over truth positions seen so far
+    inversions = 0
+    for seen, player in enumerate(ranking):
+        index = position[player] + 1
+        below = 0
+        while index:
+            below += tree[index]
+            index -= index & -index
+        inversions += seen - below
+        index = position[player] + 1
+        while index <= size:
+            tree[index] += 1
+            index += index & -index
+    pairs = size * (size - 1) // 2
+    return 1 - 2 * inversions / pairs if pairs else 1.0
+
+
+def precision_at(k, ranking, truth):
+    """Fraction of the first k of truth that are in the first k of ranking"""
+    k = min(k, len(truth))
+    return len(set(ranking[:k]) & set(truth[:k])) / k
+
+
+def version():
+    try:
+        return subprocess.run(
+            ["git", "describe", "--always", "--dirty"],
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run_elo_sorted(truth, key, top, limit, minimum, seed, backend="elo"):
+    """
+    One elo_sorted run over shuffled truth in a throwaway league folder.
+    Returns the ranking, the comparisons played and the seconds it took.
+    """
+    players = list(truth)
+    Random(seed).shuffle(players)
+    leagues_folder = elo_sort.LEAGUES_FOLDER
+    with tempfile.TemporaryDirectory() as folder:
+        elo_sort.LEAGUES_FOLDER = folder
+        try:
+            start = perf_counter()
+            with redirect_stdout(io.StringIO()):
+                ranking = elo_sort.elo_sorted(
+                    players,
+                    "quality",
+                    top=top,
+                    limit=limit,
+                    key=key,
+                    minimum=minimum,
+                    backend=backend,
+                )
+            elapsed = perf_counter() - start
+            with elo_sort.League.load("quality") as league:
+                comparisons = int(league._games[: league.size].sum()) // 2
+        finally:
+            elo_sort.LEAGUES_FOLDER = leagues_folder
+    return ranking, comparisons, elapsed
+
+
+def run_sorted_tstt(truth, key, top, limit, minimum, seed, backend=None):
+    """
+    One sorted_tstt run, as run_elo_sorted. sorted_tstt ranks higher keys
+    first and elo_sorted lower ones, so it is given the opposite key.
+    """
+    players = list(truth)
+    Random(seed).shuffle(players)
+    leagues_folder = tstt_sort.LEAGUES_FOLDER
+    with tempfile.TemporaryDirectory() as folder:
+        tstt_sort.LEAGUES_FOLDER = folder
+        try:
+            start = perf_counter()
+            ranking = tstt_sort.sorted_tstt(
+                players,
+                "quality",
+                top=top,
+                limit=limit,
+                key=lambda player: -key(player),
+                minimum=minimum,
+            )
+            elapsed = perf_counter() - start
+            league = tstt_sort.LEAGUE_CACHE.pop("quality")
+            league.close()
+            comparisons = len(league.matches)
+        finally:
+            tstt_sort.LEAGUES_FOLDER = leagues_folder
+    return ranking, comparisons, elapsed
+
+
+ENGINES = {"elo": run_elo_sorted, "tstt": run_sorted_tstt}
+
+
+def comparisons_to(target, run, truth, key, top, minimum, seed, backend):
+    """
+    Comparisons of the first run, with limits doubling from the number of
+    players up to 8 N log N, to rank with a Kendall tau of at least target;
+    None if none does. Each run is made to play its limit, with minimum, so
+    engines that stop early are measured by how far more comparisons go.
+    """
+    size = len(truth)
+    limit = size
+    while limit <= 8 * size * log(size):
+        ranking, comparisons, _ = run(
+            truth, key, top, limit, max(minimum, limit), seed, backend
+        )
+        if kendall_tau(ranking, truth) >= target:
+            return comparisons
+        if comparisons < limit:
+            return None  # nothing left to compare
+        limit *= 2
+    return None
+
+
+def measure(
+    size, noise, top, limit, minimum, k, seed, backend="elo", engine="elo", target=None
+):
+    truth, key = synthetic(size, noise, seed)
+    run = ENGINES[engine]
+    cpu = process_time()
+    ranking, comparisons, elapsed = run(truth, key, top, limit, minimum, seed, backend)
+    cpu = process_time() - cpu
+    tracemalloc.start()
+    run(truth, key, top, limit, minimum, seed, backend)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    record = {
+        "engine": engine,
+        "size": size,
+        "noise": noise,
+        "top": top,
+        "limit": limit,
+        "minimum": minimum,
+        "seed": seed,
+        "backend": backend,
+        "comparisons": comparisons,
+        "seconds": elapsed,
+        "cpu_seconds": cpu,
+        "seconds_per_comparison": elapsed / comparisons if comparisons else None,
+        "peak_memory_bytes": peak,
+        "kendall_tau": kendall_tau(ranking, truth),
+        f"precision_at_{k}": precision_at(k, ranking, truth),
+    }
+    if target is not None:
+        record[f"comparisons_to_tau_{target}"] = comparisons_to(
+            target, run, truth, key, top, minimum, seed, backend
+        )
+    return record
+
+
+def replay_into(engine, matches, backend=None):
+    """Ranking of a league of engine fed matches, (winner, loser) pairs"""
+    players = list(dict.fromkeys(player for match in matches for player in match))
+    if engine == "elo":
+        league = elo_sort.League(backend or "elo")
+        league.add_players(players)
+        for winner, loser in matches:
+            league.add_result(winner, ">", loser)
+        league.end_period()
+        return [player for _, player in league.get_ranking()]
+    league = tstt_sort.TSTTLeague()
+    league.add_players(players)
+    for winner, loser in matches:
+        league.add_result(winner, loser)
+    return league.get_ranked_players()
+
+
+def measure_replay(path, engine, backend, k):
+    with open(path, encoding="utf-8") as file:
+        matches = [
+            tuple(line.rstrip("\n").split("\t")) for line in file if line.strip()
+        ]
+    wins = Counter(winner for winner, _ in matches)
+    games = Counter(player for match in matches for player in match)
+    reference = sorted(games, key=lambda player: -wins[player] / games[player])
+    cpu, start = process_time(), perf_counter()
+    ranking = replay_into(engine, matches, backend)
+    elapsed, cpu = perf_counter() - start, process_time() - cpu
+    tracemalloc.start()
+    replay_into(engine, matches, backend)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return {
+        "engine": engine,
+        "replay": str(path),
+        "size": len(games),
+        "backend": backend,
+        "comparisons": len(matches),
+        "seconds": elapsed,
+        "cpu_seconds": cpu,
+        "seconds_per_comparison": elapsed / len(matches) if matches else None,
+        "peak_memory_bytes": peak,
+        "kendall_tau_to_wins": kendall_tau(ranking, reference),
+        f"precision_at_{k}_to_wins": precision_at(k, ranking, reference),
+    }
+
+
+@click.command()
+@click.option("-s", "--size", "sizes", type=int, multiple=True)
+@click.option("--noise", "noises", type=float, multiple=True)
+@click.option("-t", "--top", "tops", type=int, multiple=True)
+@click.option("-l", "--limit", "limits", type=int, multiple=True)
+@click.option("-m", "--minimum", "minimums", type=int, multiple=True)
+@click.option("-k", type=int, default=10, help="for top-k precision")
+@click.option("--seed", "seeds", type=int, multiple=True)
+@click.option(
+    "--backend", "backends", type=click.Choice(list(elo_sort.BACKENDS)), multiple=True
+)
+@click.option(
+    "-e", "--engine", "engines", type=click.Choice(list(ENGINES)), multiple=True
+)
+@click.option("--target-tau", type=float, help="also count comparisons to reach it")
+@click.option("--replay", "replays", type=click.Path(exists=True), multiple=True)
+@click.option("-o", "--output", type=click.File("w"), default=sys.stdout)
+def main(
+    sizes,
+    noises,
+    tops,
+    limits,
+    minimums,
+    k,
+    seeds,
+    backends,
+    engines,
+    target_tau,
+    replays,
+    output,
+):
+    """
+    Every combination of the options is run; limit and top default to
+    each engine's own defaults. Backends are only combined with elo.
+    With replays, only the replays are run.
+    """
+    engines = engines or ("elo",)
+    backends = backends or ("elo",)
+    combinations = [
+        (engine, backend)
+        for engine in engines
+        for backend in (backends if engine == "elo" else (None,))
+    ]
+    if replays:
+        runs = [
+            measure_replay(path, engine, backend, k)
+            for path, (engine, backend) in product(replays, combinations)
+        ]
+    else:
+        runs = [
+            measure(
+                size, noise, top, limit, minimum, k, seed, backend, engine, target_tau
+            )
+            for size, noise, top, limit, minimum, seed, (engine, backend) in product(
+                sizes or (100, 1000),
+                noises or (0.0,),
+                tops or (None,),
+                limits or (None,),
+                minimums or (0,),
+                seeds or (0,),
+                combinations,
+            )
+        ]
+    report = {
+        "version": version(),
+        "python": platform.python_version(),
+        "date": datetime.now(timezone.utc).isoformat(timespec="seconds"),
+        "runs": runs,
+    }
+    json.dump(report, output, indent=2)
+    output.write("\n")
+
+
+if __name__ == "__main__":
+    main()
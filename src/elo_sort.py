@@ -1,14 +1,15 @@
 #!/usr/bin/env python
 
-from itertools import takewhile, combinations
-from math import log, ceil
+from collections.abc import Mapping
+from functools import cache, lru_cache
+from math import erf, erfc, exp, fabs, inf, log, ceil, sqrt
 from pathlib import Path
-from statistics import NormalDist
+import json
 import os
 import pickle
 import sys
 
-import click
+import numpy as np
 
 RESULTS = {
     "<": 0,
@@ -17,9 +18,21 @@ RESULTS = {
 }
 K_SIGMA = 1  # higher sigma, more priority to new players
 LEAGUES_FOLDER = os.path.expanduser("~/.elo_sort/leagues/")
-os.makedirs(LEAGUES_FOLDER, exist_ok=True)
 OVERLAP_THRESHOLD = 0.01
-
+OVERLAP_CHUNK = 2**20  # max pairs evaluated at once by MatchEngine
+EXECUTORS = {"thread": "ThreadPoolExecutor", "process": "ProcessPoolExecutor"}
+COMPACT_EVERY = 1000  # journal entries (or league size, if bigger) per snapshot
+OVERLAP_CACHE = 2**16  # memoized scalar overlaps
+ERF_DEGREE = 20  # of the Chebyshev interpolants in erf_array
+SQRT2 = sqrt(2.0)
+GLICKO2_SCALE = 173.7178  # rating points per Glicko-2 unit
+GLICKO2_DEVIATION = 350.0  # of new players, in rating points
+GLICKO2_VOLATILITY = 0.06  # of new players
+GLICKO2_TAU = 0.5  # constrains the change of volatility
+GLICKO2_EPSILON = 1e-6  # convergence of the volatility iteration
+COLUMNS_MAGIC = b"ELOCOLS2"
+# magic, epoch, bytes of the journal covered, players, bytes of names
+COLUMNS_HEADER = "<8sQQQQ"
 
 
 def calculate_elo(elo, result, expected_result, k):
@@ -32,108 +45,1020 @@ def get_expected_result(elo_white, elo_black):
     return 1 / ((10.0 ** (exp)) + 1)
 
 
+@cache
+def _erf_pieces():
+    """
+    Chebyshev interpolants of erf on [0, 1] and of erfc(x) * exp(x * x) on
+    [1, 3] and [3, 6], off from math.erf by less than 1e-14. Past 6, erfc
+    is 0 to double precision.
+    """
+    from numpy.polynomial.chebyshev import chebinterpolate
+
+    def interpolate(function, low, high):
+        function = np.vectorize(function, otypes=[float])
+        coefficients = chebinterpolate(
+            lambda t: function(low + (t + 1) * (high - low) / 2), ERF_DEGREE
+        )
+        return low, high, coefficients
+
+    scaled = lambda x: erfc(x) * exp(x * x)
+    return (
+        (*interpolate(erf, 0, 1), False),
+        (*interpolate(scaled, 1, 3), True),
+        (*interpolate(scaled, 3, 6), True),
+    )
+
+
+def erfc_array(x):
+    """Vectorized math.erfc"""
+    from numpy.polynomial.chebyshev import chebval
+
+    x = np.asarray(x, dtype=float)
+    magnitude = np.abs(x)
+    result = np.zeros(x.shape)
+    for low, high, coefficients, scaled in _erf_pieces():
+        inside = (low <= magnitude) & (magnitude < high)
+        if not inside.any():
+            continue
+        value = magnitude[inside]
+        fitted = chebval((2 * value - (low + high)) / (high - low), coefficients)
+        result[inside] = np.exp(-value * value) * fitted if scaled else 1 - fitted
+    return np.where(x < 0, 2 - result, result)
+
+
+def erf_array(x):
+    """Vectorized math.erf"""
+    x = np.asarray(x, dtype=float)
+    return np.copysign(1 - erfc_array(x), x)
+
+
+def _normal_cdf(x, mu, sigma):
+    return 0.5 * (1.0 + erf_array((x - mu) / (sigma * SQRT2)))
+
+
+def overlap(mu_x, sigma_x, mu_y, sigma_y):
+    """
+    NormalDist(mu_x, sigma_x).overlap(NormalDist(mu_y, sigma_y)) without
+    building the distributions, memoized on both (mu, sigma).
+    """
+    if (sigma_y, mu_y) < (sigma_x, mu_x):
+        mu_x, sigma_x, mu_y, sigma_y = mu_y, sigma_y, mu_x, sigma_x
+    return _overlap(float(mu_x), float(sigma_x), float(mu_y), float(sigma_y))
+
+
+@lru_cache(maxsize=OVERLAP_CACHE)
+def _overlap(mu_x, sigma_x, mu_y, sigma_y):
+    # Inman and Bradley, as in statistics.NormalDist.overlap
+    var_x = sigma_x * sigma_x
+    var_y = sigma_y * sigma_y
+    dv = var_y - var_x
+    dm = fabs(mu_y - mu_x)
+    if not dv:
+        return erfc(dm / (2.0 * sigma_x * SQRT2))
+    a = mu_x * var_y - mu_y * var_x
+    b = sigma_x * sigma_y * sqrt(dm * dm + dv * log(var_y / var_x))
+    x1 = (a + b) / dv
+    x2 = (a - b) / dv
+    cdf_x1 = erf((x1 - mu_x) / (sigma_x * SQRT2))
+    cdf_y1 = erf((x1 - mu_y) / (sigma_y * SQRT2))
+    cdf_x2 = erf((x2 - mu_x) / (sigma_x * SQRT2))
+    cdf_y2 = erf((x2 - mu_y) / (sigma_y * SQRT2))
+    return 1.0 - 0.5 * (fabs(cdf_y1 - cdf_x1) + fabs(cdf_y2 - cdf_x2))
+
+
+def overlap_array(mu_x, sigma_x, mu_y, sigma_y):
+    """Vectorized overlap()"""
+    mu_x, sigma_x, mu_y, sigma_y = np.broadcast_arrays(
+        *(np.asarray(value, dtype=float) for value in (mu_x, sigma_x, mu_y, sigma_y))
+    )
+    dm = np.abs(mu_y - mu_x)
+    if (sigma_x == sigma_y).all():
+        return erfc_array(dm / (2.0 * sigma_x * SQRT2))
+
+    swap = sigma_y < sigma_x
+    mu_x, mu_y = np.where(swap, mu_y, mu_x), np.where(swap, mu_x, mu_y)
+    sigma_x, sigma_y = (
+        np.where(swap, sigma_y, sigma_x),
+        np.where(swap, sigma_x, sigma_y),
+    )
+    var_x = sigma_x * sigma_x
+    var_y = sigma_y * sigma_y
+    dv = var_y - var_x
+    result = np.empty(dm.shape)
+
+    equal = dv == 0
+    result[equal] = erfc_array(dm[equal] / (2.0 * sigma_x[equal] * SQRT2))
+
+    unequal = ~equal
+    mu_x, sigma_x, var_x = mu_x[unequal], sigma_x[unequal], var_x[unequal]
+    mu_y, sigma_y, var_y = mu_y[unequal], sigma_y[unequal], var_y[unequal]
+    dv, dm = dv[unequal], dm[unequal]
+    a = mu_x * var_y - mu_y * var_x
+    b = sigma_x * sigma_y * np.sqrt(dm * dm + dv * np.log(var_y / var_x))
+    x1 = (a + b) / dv
+    x2 = (a - b) / dv
+    result[unequal] = 1.0 - (
+        np.abs(_normal_cdf(x1, mu_y, sigma_y) - _normal_cdf(x1, mu_x, sigma_x))
+        + np.abs(_normal_cdf(x2, mu_y, sigma_y) - _normal_cdf(x2, mu_x, sigma_x))
+    )
+    return result
+
+
+def _overlap_reach(threshold):
+    """
+    Distance, in sums of sigmas, beyond which two normals cannot overlap
+    more than threshold.
+    """
+    if threshold <= 0:
+        return inf
+    from statistics import NormalDist
+
+    return NormalDist().inv_cdf(1 - threshold / 2)
+
+
+class MatchEngine:
+    """
+    Ratings and sigmas of a league held in arrays, so the overlap of many
+    candidate pairs is computed in one vectorized pass instead of one
+    NormalDist per player per pair. Players are referred to by league id.
+    """
+
+    def __init__(self, league):
+        self.elos = league._elos[: league.size]
+        self.sigmas = league.backend.sigmas(slice(0, league.size))
+
+    def overlap(self, left, right):
+        return overlap_array(
+            self.elos[left], self.sigmas[left], self.elos[right], self.sigmas[right]
+        )
+
+    def neighbours(self, players, candidates, threshold, prune=True):
+        """
+        Candidates overlapping more than threshold with any of players, in
+        the order a nested loop over players and candidates would find them.
+
+        Two normals with means d apart overlap at most
+        erfc(d / ((sigma_1 + sigma_2) * sqrt(2))), so with prune only the
+        candidates rated within reach of each player are compared, where
+        reach makes that bound equal to threshold. Candidates already
+        selected are not compared again.
+        """
+        if threshold >= 1:
+            return np.empty(0, dtype=np.intp)
+        reach = _overlap_reach(threshold) if prune else inf
+        elos = self.elos[candidates]
+        by_elo = np.argsort(elos, kind="stable")
+        sigma_max = self.sigmas[candidates].max(initial=0)
+        added = np.zeros(len(candidates), dtype=bool)
+        selected = []
+        start = 0
+        while start < len(players):
+            remaining = by_elo[~added[by_elo]]
+            if not len(remaining):
+                break
+            if reach == inf:
+                block = players[start : start + OVERLAP_CHUNK // len(remaining) + 1]
+                row = np.repeat(np.arange(len(block)), len(remaining))
+                column = np.tile(remaining, len(block))
+            else:
+                block = players[start : start + 1024]
+                width = reach * (self.sigmas[block] + sigma_max) * (1 + 1e-9)
+                sorted_elos = elos[remaining]
+                low = np.searchsorted(sorted_elos, self.elos[block] - width)
+                high = np.searchsorted(sorted_elos, self.elos[block] + width, "right")
+                counts = high - low
+                rows = max(1, np.searchsorted(np.cumsum(counts), OVERLAP_CHUNK))
+                block, low, counts = block[:rows], low[:rows], counts[:rows]
+                row = np.repeat(np.arange(rows), counts)
+                offset = np.arange(len(row)) - np.repeat(
+                    np.cumsum(counts) - counts, counts
+                )
+                column = remaining[np.repeat(low, counts) + offset]
+            start += len(block)
+
+            left, right = block[row], candidates[column]
+            keep = left != right
+            keep[keep] = self.overlap(left[keep], right[keep]) > threshold
+            row, column = row[keep], column[keep]
+            column = column[np.lexsort((column, row))]
+            column, first = np.unique(column, return_index=True)
+            column = column[np.argsort(first)]
+            added[column] = True
+            selected.append(candidates[column])
+        if not selected:
+            return np.empty(0, dtype=np.intp)
+        return np.concatenate(selected)
+
+    def best_match(self, selected, threshold):
+        """
+        Most overlapping pair among neighbours in selected, looking one
+        further position away only if no neighbours overlap above threshold.
+        """
+        top_overlap = 0
+        top_match = None
+        for distance in range(1, min(len(selected), 3)):
+            overlaps = self.overlap(selected[:-distance], selected[distance:])
+            best = int(np.argmax(overlaps))
+            if overlaps[best] > top_overlap:
+                top_overlap = float(overlaps[best])
+                top_match = (int(selected[best]), int(selected[best + distance]))
+            if top_overlap > threshold:
+                break
+        return top_match, top_overlap
+
+    def best_matches(self, selected, threshold, k):
+        """
+        Up to k disjoint pairs among neighbours (or one position further
+        away) in selected, overlapping more than threshold, neighbours first.
+        Falls back to best_match when no pair is above threshold.
+        """
+        lefts, rights, overlaps, distances = [], [], [], []
+        for distance in range(1, min(len(selected), 3)):
+            lefts.append(selected[:-distance])
+            rights.append(selected[distance:])
+            overlaps.append(self.overlap(lefts[-1], rights[-1]))
+            distances.append(np.full(len(overlaps[-1]), distance))
+        if not lefts:
+            return []
+        left, right, overlap, distance = map(
+            np.concatenate, (lefts, rights, overlaps, distances)
+        )
+        informative = np.flatnonzero(overlap > threshold)
+        if not len(informative):
+            top_match, top_overlap = self.best_match(selected, threshold)
+            return [] if top_match is None else [(top_match, top_overlap)]
+
+        order = informative[np.lexsort((-overlap[informative], distance[informative]))]
+        matches = []
+        used = set()
+        for index in order:
+            match = (int(left[index]), int(right[index]))
+            if used.intersection(match):
+                continue
+            used.update(match)
+            matches.append((match, float(overlap[index])))
+            if len(matches) == k:
+                break
+        return matches
+
+
+class RankingIndex:
+    """
+    League ids sorted by rating, best first and ties by id. When a rating
+    changes the player is shifted to its new place, which after one game is
+    usually close to the old one, instead of sorting everybody again.
+    """
+
+    __slots__ = ("order", "keys")
+
+    def __init__(self, elos):
+        self.order = np.argsort(-elos, kind="stable")
+        self.keys = -elos[self.order]  # ascending, to use searchsorted
+
+    def position(self, player, elo):
+        low = np.searchsorted(self.keys, -elo, "left")
+        high = np.searchsorted(self.keys, -elo, "right")
+        return int(low + np.searchsorted(self.order[low:high], player))
+
+    def move(self, player, old_elo, new_elo):
+        old = self.position(player, old_elo)
+        new = self.position(player, new_elo)
+        if new > old:
+            new -= 1
+            self.order[old:new] = self.order[old + 1 : new + 1]
+            self.keys[old:new] = self.keys[old + 1 : new + 1]
+        elif new < old:
+            self.order[new + 1 : old + 1] = self.order[new:old]
+            self.keys[new + 1 : old + 1] = self.keys[new:old]
+        self.order[new] = player
+        self.keys[new] = -new_elo
+
+
+class EloRating:
+    """
+    Ratings updated after every game, with League.k() standing in for the
+    uncertainty of each rating.
+    """
+
+    name = "elo"
+    pending = ()
+
+    def __init__(self, league):
+        self.league = league
+
+    def __getstate__(self):
+        return {}
+
+    def __setstate__(self, state):
+        pass
+
+    def add_player(self, player, capacity):
+        pass
+
+    def sigmas(self, ids):
+        return self.league._k(ids) ** K_SIGMA
+
+    def add_result(self, white, black, result):
+        league = self.league
+        elo_white = float(league._elos[white])
+        elo_black = float(league._elos[black])
+        expected_result = get_expected_result(elo_white, elo_black)
+        new_elo_white = calculate_elo(
+            elo=elo_white,
+            result=result,
+            expected_result=expected_result,
+            k=float(league._k(white)),
+        )
+        new_elo_black = calculate_elo(
+            elo=elo_black,
+            result=(1 - result),
+            expected_result=(1 - expected_result),
+            k=float(league._k(black)),
+        )
+        league._set_elo(white, new_elo_white)
+        league._set_elo(black, new_elo_black)
+
+    def end_period(self):
+        return False
+
+
+def _glicko2_volatility(phi, volatility, variance, delta):
+    """Step 5 of Glickman's Glicko-2 example, the Illinois algorithm"""
+    a = log(volatility * volatility)
+
+    def f(x):
+        ex = exp(x)
+        denominator = phi * phi + variance + ex
+        return ex * (delta * delta - phi * phi - variance - ex) / (
+            2 * denominator * denominator
+        ) - (x - a) / (GLICKO2_TAU * GLICKO2_TAU)
+
+    low = a
+    if delta * delta > phi * phi + variance:
+        high = log(delta * delta - phi * phi - variance)
+    else:
+        steps = 1
+        while f(a - steps * GLICKO2_TAU) < 0:
+            steps += 1
+        high = a - steps * GLICKO2_TAU
+    f_low, f_high = f(low), f(high)
+    while fabs(high - low) > GLICKO2_EPSILON:
+        middle = low + (low - high) * f_low / (f_high - f_low)
+        f_middle = f(middle)
+        if f_middle * f_high <= 0:
+            low, f_low = high, f_high
+        else:
+            f_low /= 2
+        high, f_high = middle, f_middle
+    return exp(low / 2)
+
+
+class Glicko2Rating:
+    """
+    Glicko-2 (Glickman): every player has a rating deviation and a
+    volatility. Results are collected into rating periods, and all the
+    players of a period are rated at once against the ratings their
+    opponents had when it began.
+
+    Unlike chess players, tasks don't change while nobody compares them, so
+    a deviation only grows by the volatility in the periods its player plays.
+    """
+
+    name = "glicko2"
+
+    def __init__(self, league):
+        self.league = league
+        self.deviations = np.empty(0, dtype=np.float64)
+        self.volatilities = np.empty(0, dtype=np.float64)
+        self.pending = []  # (white, black, result) of the current period
+
+    def __getstate__(self):
+        size = self.league.size
+        return {
+            "deviations": self.deviations[:size].copy(),
+            "volatilities": self.volatilities[:size].copy(),
+            "pending": list(self.pending),
+        }
+
+    def __setstate__(self, state):
+        self.deviations = np.array(state["deviations"], dtype=np.float64)
+        self.volatilities = np.array(state["volatilities"], dtype=np.float64)
+        self.pending = [tuple(result) for result in state["pending"]]
+
+    def add_player(self, player, capacity):
+        if len(self.deviations) < capacity:
+            self.deviations = np.resize(self.deviations, capacity)
+            self.volatilities = np.resize(self.volatilities, capacity)
+        self.deviations[player] = GLICKO2_DEVIATION
+        self.volatilities[player] = GLICKO2_VOLATILITY
+
+    def sigmas(self, ids):
+        return self.deviations[ids]
+
+    def add_result(self, white, black, result):
+        self.pending.append((white, black, result))
+
+    def end_period(self):
+        """Rate the players of the current period; False if nobody played."""
+        if not self.pending:
+            return False
+        white, black, result = map(np.array, zip(*self.pending))
+        self.pending = []
+        players = np.concatenate((white, black))
+        opponents = np.concatenate((black, white))
+        scores = np.concatenate((result, 1 - result))
+
+        league = self.league
+        mu = (league._elos[players] - 1500) / GLICKO2_SCALE
+        mu_opponent = (league._elos[opponents] - 1500) / GLICKO2_SCALE
+        phi_opponent = self.deviations[opponents] / GLICKO2_SCALE
+        g = 1 / np.sqrt(1 + 3 * phi_opponent * phi_opponent / np.pi**2)
+        expected = 1 / (1 + np.exp(-g * (mu - mu_opponent)))
+
+        ids, first, inverse = np.unique(players, return_index=True, return_inverse=True)
+        variance = 1 / np.bincount(inverse, g * g * expected * (1 - expected))
+        improvement = np.bincount(inverse, g * (scores - expected))
+        mu = mu[first]
+        phi = self.deviations[ids] / GLICKO2_SCALE
+        volatility = np.array(
+            [
+                _glicko2_volatility(*arguments)
+                for arguments in zip(
+                    phi.tolist(),
+                    self.volatilities[ids].tolist(),
+                    variance.tolist(),
+                    (variance * improvement).tolist(),
+                )
+            ]
+        )
+        phi = 1 / np.sqrt(1 / (phi * phi + volatility * volatility) + 1 / variance)
+        mu = mu + phi * phi * improvement
+
+        self.volatilities[ids] = volatility
+        self.deviations[ids] = phi * GLICKO2_SCALE
+        for player, rating in zip(ids.tolist(), (1500 + GLICKO2_SCALE * mu).tolist()):
+            league._set_elo(player, rating)
+        return True
+
+
+BACKENDS = {backend.name: backend for backend in (EloRating, Glicko2Rating)}
+
+
+class _Column(Mapping):
+    """Read-only name -> value view over one of the League arrays."""
+
+    def __init__(self, league, values, kind):
+        self.league = league
+        self.values = values
+        self.kind = kind
+
+    def __getitem__(self, player):
+        return self.kind(getattr(self.league, self.values)[self.league.index[player]])
+
+    def __iter__(self):
+        return iter(self.league.names)
+
+    def __len__(self):
+        return self.league.size
+
+
+class _LeagueUnpickler(pickle.Unpickler):
+    """Leagues pickled by `python elo_sort.py` refer to __main__.League."""
+
+    def find_class(self, module, name):
+        if name == "League":
+            return League
+        return super().find_class(module, name)
+
+
+def _cut_torn_tail(path, start):
+    """
+    Truncate the JSON lines log at path after its last complete entry,
+    looking from offset start on. Only for a writer holding the log lock.
+    Shared with tstt_sort's match log.
+    """
+    with open(path, "r+b") as file:
+        file.seek(start)
+        end = start
+        for line in file:
+            if not line.endswith(b"\n"):
+                break
+            try:
+                json.loads(line)
+            except ValueError:
+                break
+            end += len(line)
+        else:
+            return
+        file.truncate(end)
+
+
+def _journal_path(path):
+    return Path(f"{path}.journal")
+
+
+def _columns_path(path):
+    return Path(f"{path}.columns")
+
+
+def _changed_on_disk(path):
+    return RuntimeError(f"{path} was changed by another process, load the league again")
+
+
+def _journal_header(path):
+    try:
+        with open(path, "rb") as file:
+            header = json.loads(file.readline())
+    except (FileNotFoundError, ValueError):
+        return None
+    return header if isinstance(header, dict) else None
+
+
 class League:
-    def __init__(self):
-        self.elos = dict()
-        self.games = dict()
-        self.perfect_score_players = set()
+    """
+    Players are interned to integer ids (their position in names), ratings,
+    games and unbeaten flags are kept in arrays indexed by those ids.
+
+    How ratings and their uncertainty are updated is up to the rating
+    backend, one of BACKENDS. Backends that rate results in batches rate
+    them when end_period() is called, so reading the ratings never changes
+    them. elo_sorted ends a period after each batch, elo_sortd on each
+    flush.
+
+    A league on disk is a pickled snapshot plus an append-only journal of the
+    players, results and period ends added since. Every snapshot gets a new epoch, written
+    as the journal header, so a journal left behind by an interrupted
+    compaction is recognized and ignored.
+    """
+
+    __slots__ = (
+        "names",
+        "index",
+        "size",
+        "_elos",
+        "_games",
+        "_unbeaten",
+        "path",
+        "epoch",
+        "_journal",
+        "_pending",
+        "_torn",
+        "_journal_size",
+        "_ranking",
+        "backend",
+    )
+
+    def __init__(self, backend="elo"):
+        self.names = []
+        self.index = {}
+        self.size = 0
+        self._elos = np.empty(0, dtype=np.float64)
+        self._games = np.empty(0, dtype=np.int32)
+        self._unbeaten = np.empty(0, dtype=bool)
+        self.path = None
+        self.epoch = 0
+        self._journal = None
+        self._pending = 0  # journal entries since the last snapshot
+        self._torn = None  # offset of a torn journal tail, cut by the writer
+        self._journal_size = None  # bytes of the journal this league has seen
+        self._ranking = None  # RankingIndex, built when first needed
+        self.backend = BACKENDS[backend](self)
+
+    def __getstate__(self):
+        return {
+            "epoch": self.epoch,
+            "names": self.names,
+            "elos": self._elos[: self.size].copy(),
+            "games": self._games[: self.size].copy(),
+            "unbeaten": self._unbeaten[: self.size].copy(),
+            "backend": self.backend.name,
+            "backend_state": self.backend.__getstate__(),
+        }
+
+    def __setstate__(self, state):
+        self.__init__(state.get("backend", "elo"))
+        if isinstance(state["elos"], dict):
+            # pickled before the array storage: three dicts/sets keyed by name
+            for player, elo in state["elos"].items():
+                self._add_player(
+                    player,
+                    rating=elo,
+                    games=state["games"][player],
+                    unbeaten=player in state["perfect_score_players"],
+                )
+            return
+        self.epoch = state.get("epoch", 0)
+        self.names = list(state["names"])
+        self.index = {player: index for index, player in enumerate(self.names)}
+        self.size = len(self.names)
+        self._elos = np.array(state["elos"], dtype=np.float64)
+        self._games = np.array(state["games"], dtype=np.int32)
+        self._unbeaten = np.array(state["unbeaten"], dtype=bool)
+        self.backend.__setstate__(state.get("backend_state", {}))
+
+    @property
+    def elos(self):
+        return _Column(self, "_elos", float)
+
+    @property
+    def games(self):
+        return _Column(self, "_games", int)
+
+    @property
+    def perfect_score_players(self):
+        return {
+            self.names[index] for index in np.flatnonzero(self._unbeaten[: self.size])
+        }
 
     @classmethod
-    def load(cls, name, create=False):
+    def load(cls, name, create=False, backend="elo"):
+        """backend of the league, if it has to be created"""
         name = name or "default"
         path = Path(LEAGUES_FOLDER) / name
         try:
             with open(path, "rb") as file:
-                league = pickle.load(file)
+                league = _LeagueUnpickler(file).load()
         except FileNotFoundError:
-            if not create:
+            header = _journal_header(_journal_path(path))
+            if not create and header is None:
                 raise
-            league = cls()
+            league = cls((header or {}).get("backend", backend))
         league.path = path
+        league._replay()
         return league
 
-    def save(self, name=None):
-        if name is None:
-            if self.path is None:
-                raise ValueError("League has no path or name")
+    def _replay(self):
+        """
+        Apply the journal entries written after the snapshot. A torn last
+        line, from a crash in the middle of a write, is skipped here and cut
+        off before this league first writes to the journal.
+        """
+        path = _journal_path(self.path)
+        try:
+            file = open(path, "rb")
+        except FileNotFoundError:
+            return
+        with file:
+            header = file.readline()
+            try:
+                if json.loads(header)["epoch"] != self.epoch:
+                    return
+            except ValueError:
+                return
+            end = file.tell()
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if len(entry) == 1:
+                    self.backend.end_period()
+                elif len(entry) == 2:
+                    self._add_player(entry[1])
+                else:
+                    self._add_result(*entry)
+                self._pending += 1
+                end += len(line)
             else:
-                path = self.path
-        else:
+                self._journal_size = end
+                return
+            self._torn = self._journal_size = end
+
+    def _log(self, *entry):
+        if self.path is None:
+            return
+        import fcntl
+
+        path = _journal_path(self.path)
+        if self._journal is None:
+            if self._journal_size is None:
+                epoch = (_journal_header(path) or {}).get("epoch", -1)
+                if epoch >= self.epoch:
+                    raise _changed_on_disk(path)
+                # no journal yet, or one left by an interrupted compaction
+                self._write_journal(path)
+                self._journal_size = os.path.getsize(path)
+            self._journal = open(path, "a", encoding="utf-8")
+        # appends and repairs of the journal exclude each other across
+        # processes, so a torn line seen under the lock is from a crash
+        fcntl.flock(self._journal, fcntl.LOCK_EX)
+        try:
+            if self._torn is not None:
+                _cut_torn_tail(self._journal.name, self._torn)
+                self._torn = None
+            self._check_journal(self._journal, path)
+            self._journal.write(json.dumps(entry) + "\n")
+            self._journal.flush()
+            self._journal_size = os.fstat(self._journal.fileno()).st_size
+        finally:
+            fcntl.flock(self._journal, fcntl.LOCK_UN)
+        self._pending += 1
+
+    def _check_journal(self, file, path):
+        """
+        Refuse to write over results another process journaled since this
+        league read the journal: they would be lost.
+        """
+        stat = os.fstat(file.fileno())
+        try:
+            replaced = os.stat(path).st_ino != stat.st_ino
+        except FileNotFoundError:
+            replaced = True
+        if replaced or stat.st_size != self._journal_size:
+            raise _changed_on_disk(path)
+
+    def _journal_header_line(self):
+        header = {"epoch": self.epoch}
+        if self.backend.name != "elo":
+            header["backend"] = self.backend.name
+        return json.dumps(header) + "\n"
+
+    def _write_journal(self, path):
+        temporary = Path(f"{path}.tmp")
+        temporary.parent.mkdir(parents=True, exist_ok=True)
+        with open(temporary, "w", encoding="utf-8") as file:
+            file.write(self._journal_header_line())
+        os.replace(temporary, path)
+
+    def _write_snapshot(self, path):
+        """
+        Columns, snapshot and then journal, each replaced whole: until the
+        new journal is in place, neither the new snapshot nor its columns
+        match the journal there, so a crash leaves nothing they accept.
+        """
+        epoch = self.epoch
+        journal = _journal_path(path)
+        if path != self.path:
+            # the copy gets an epoch the journal it replaces does not have
+            old = (_journal_header(journal) or {}).get("epoch", -1)
+            self.epoch = max(epoch, old + 1)
+        try:
+            temporary = Path(f"{path}.tmp")
+            temporary.parent.mkdir(parents=True, exist_ok=True)
+            self._write_columns(
+                _columns_path(path), len(self._journal_header_line().encode())
+            )
+            with open(temporary, "wb") as file:
+                pickle.dump(self, file)
+            os.replace(temporary, path)
+            self._write_journal(journal)
+        finally:
+            self.epoch = epoch
+
+    def _write_columns(self, path, journal_size):
+        """
+        The ranking of the league, as of the first journal_size bytes of
+        its journal, for LeagueColumns: names, ratings and games by id, ids
+        by rating and by name, and the rank of each id. Not written while a
+        rating period is open, its ratings are stale.
+        """
+        import struct
+
+        if self.backend.pending:
+            path.unlink(missing_ok=True)
+            return
+        names = [name.encode() for name in self.names]
+        offsets = np.zeros(self.size + 1, dtype="<i8")
+        np.cumsum([len(name) for name in names], out=offsets[1:])
+        order = RankingIndex(self._elos[: self.size]).order
+        ranks = np.empty(self.size, dtype="<i8")
+        ranks[order] = np.arange(self.size)
+        by_name = sorted(range(self.size), key=names.__getitem__)
+        header = struct.pack(
+            COLUMNS_HEADER,
+            COLUMNS_MAGIC,
+            self.epoch,
+            journal_size,
+            self.size,
+            offsets[-1],
+        )
+        temporary = Path(f"{path}.tmp")
+        with open(temporary, "wb") as file:
+            file.write(header)
+            for column in (
+                offsets,
+                self._elos[: self.size].astype("<f8"),
+                order.astype("<i8"),
+                ranks,
+                np.array(by_name, dtype="<i8"),
+                self._games[: self.size].astype("<i8"),
+            ):
+                file.write(column.tobytes())
+            file.write(b"".join(names))
+        os.replace(temporary, path)
+
+    def compact(self):
+        """Write a snapshot of the league and start an empty journal."""
+        if self.path is None:
+            raise ValueError("League has no path or name")
+        import fcntl
+
+        self.close()
+        path = _journal_path(self.path)
+        try:
+            journal = open(path, "rb")
+        except FileNotFoundError:
+            journal = None
+        try:
+            if journal is not None:
+                # appends wait until the journal they would go to is replaced
+                fcntl.flock(journal, fcntl.LOCK_EX)
+            if self._journal_size is not None:
+                if journal is None:
+                    raise _changed_on_disk(path)
+                self._check_journal(journal, path)
+            elif (_journal_header(path) or {}).get("epoch", -1) >= self.epoch:
+                raise _changed_on_disk(path)
+            self.epoch += 1
+            self._write_snapshot(self.path)
+            self._journal_size = os.path.getsize(path)
+        finally:
+            if journal is not None:
+                journal.close()
+        self._pending = 0
+
+    def close(self):
+        if self._journal is not None:
+            self._journal.close()
+            self._journal = None
+
+    def save(self, name=None):
+        """
+        Results are journaled as they are added, so saving only compacts
+        once the journal has grown as big as a snapshot. Otherwise it brings
+        the columns up to the journal, for open_ranking.
+        """
+        if name is not None:
             path = Path(LEAGUES_FOLDER) / name
-        with open(path, "wb") as file:
-            pickle.dump(self, file)
+            if path != self.path:
+                self._write_snapshot(path)
+                return
+        if self.path is None:
+            raise ValueError("League has no path or name")
+        if self._pending >= max(COMPACT_EVERY, self.size):
+            self.compact()
+        elif self._pending and self._journal_size is not None:
+            self._write_columns(_columns_path(self.path), self._journal_size)
 
     def __enter__(self):
         return self
 
     def __exit__(self, exc_type, exc_value, traceback):
         self.save()
+        self.close()
 
-    def _add_player(self, name, rating=1500, games=0):
-        self.elos[name] = rating
-        self.games[name] = games
-        self.perfect_score_players.add(name)
+    def _add_player(self, name, rating=1500, games=0, unbeaten=True):
+        if self.size == len(self._elos):
+            capacity = max(16, 2 * self.size)
+            self._elos = np.resize(self._elos, capacity)
+            self._games = np.resize(self._games, capacity)
+            self._unbeaten = np.resize(self._unbeaten, capacity)
+        self.index[name] = self.size
+        self.names.append(name)
+        self._elos[self.size] = rating
+        self._games[self.size] = games
+        self._unbeaten[self.size] = unbeaten
+        self.backend.add_player(self.size, len(self._elos))
+        self.size += 1
+        self._ranking = None
 
     def add_players(self, players, on_conflict="ignore"):
         for player in players:
-            if player in self.elos:
+            if player in self.index:
                 if on_conflict == "ignore":
                     continue
                 else:
                     raise ValueError(f"Player {player} already exists")
             self._add_player(player)
+            self._log("+", player)
+
+    def _ids(self, players):
+        return np.fromiter((self.index[player] for player in players), dtype=np.intp)
+
+    def _k(self, ids):
+        return 800 / np.maximum(self._games[ids], 2)
 
     def k(self, player):
-        return 800 / max(self.games[player], 2)
+        return 800 / max(int(self._games[self.index[player]]), 2)
 
     def add_result(self, white, relation, black):
-        elo_white = self.elos[white]
-        elo_black = self.elos[black]
-        result = RESULTS[relation]
-        expected_result = get_expected_result(elo_white, elo_black)
+        self._add_result(white, relation, black)
+        self._log(white, relation, black)
+
+    def _add_result(self, white, relation, black):
+        id_white = self.index[white]
+        id_black = self.index[black]
         if relation in "=>":
-            self.perfect_score_players.discard(black)
+            self._unbeaten[id_black] = False
         if relation in "<=":
-            self.perfect_score_players.discard(white)
-        new_elo_white = calculate_elo(
-            elo=elo_white,
-            result=result,
-            expected_result=expected_result,
-            k=self.k(white),
-        )
-        new_elo_black = calculate_elo(
-            elo=elo_black,
-            result=(1 - result),
-            expected_result=(1 - expected_result),
-            k=self.k(black),
-        )
-        self.elos[white] = new_elo_white
-        self.elos[black] = new_elo_black
-        self.games[white] += 1
-        self.games[black] += 1
+            self._unbeaten[id_white] = False
+        self.backend.add_result(id_white, id_black, RESULTS[relation])
+        self._games[id_white] += 1
+        self._games[id_black] += 1
+
+    def _set_elo(self, player, elo):
+        if self._ranking is not None:
+            self._ranking.move(player, float(self._elos[player]), elo)
+        self._elos[player] = elo
+
+    def end_period(self):
+        """Rate the results of the current rating period, if any."""
+        if self.backend.end_period():
+            self._log("/")
+
+    def overlap(self, player, other):
+        """Overlap of the rating distributions of two players"""
+        ids = self._ids((player, other))
+        sigmas = self.backend.sigmas(ids)
+        return overlap(self._elos[ids[0]], sigmas[0], self._elos[ids[1]], sigmas[1])
 
     def _get_norm_dist(self, player):
-        sigma = (self.k(player)) ** K_SIGMA
+        from statistics import NormalDist
+
         mu = self.elos[player]
+        sigma = float(self.backend.sigmas(self.index[player]))
         return NormalDist(mu=mu, sigma=sigma)
 
-    def get_ranking(self, players=None) -> list[tuple[int, str]]:
+    def _all_ids(self, players=None):
         if players is None:
-            players = self.elos.keys()
-        elos_players = [(self.elos[player], player) for player in players]
-        elos_players.sort(reverse=True, key=lambda elo_player: elo_player[0])
-        return elos_players
+            return np.arange(self.size)
+        return np.unique(self._ids(players))
 
-    def get_games_played(self, players=None):
+    def _ranked(self, ids=None):
+        """ids (all by default) sorted by rating, best first"""
+        if ids is not None and len(ids) * 16 < self.size:
+            return ids[np.argsort(-self._elos[ids], kind="stable")]
+        if self._ranking is None:
+            self._ranking = RankingIndex(self._elos[: self.size])
+        if ids is None or len(ids) == self.size:
+            return self._ranking.order
+        selected = np.zeros(self.size, dtype=bool)
+        selected[ids] = True
+        return self._ranking.order[selected[self._ranking.order]]
+
+    def _with_names(self, ids):
+        return list(zip(self._elos[ids].tolist(), (self.names[index] for index in ids)))
+
+    def get_ranking(self, players=None) -> list[tuple[float, str]]:
+        if players is None:
+            return self._with_names(self._ranked())
+        return self._with_names(self._ranked(self._all_ids(players)))
+
+    def top(self, n, players=None) -> list[tuple[float, str]]:
+        """first n of get_ranking(players)"""
         if players is None:
-            players = self.games.keys()
-        games_players = [(self.games[player], player) for player in players]
-        games_players.sort(key=lambda game_player: game_player[0])
-        return games_players
+            return self._with_names(self._ranked()[:n])
+        return self._with_names(self._ranked(self._all_ids(players))[:n])
+
+    def rank_of(self, player) -> int:
+        """position of player in get_ranking(), starting at 1"""
+        self._ranked()
+        index = self.index[player]
+        return self._ranking.position(index, self._elos[index]) + 1
+
+    def get_games_played(self, players=None):
+        ids = self._all_ids(players)
+        ids = ids[np.argsort(self._games[ids], kind="stable")]
+        return list(
+            zip(self._games[ids].tolist(), (self.names[index] for index in ids))
+        )
 
     def __repr__(self):
         return "\n".join(f"{player} ({elo})" for elo, player in self.get_ranking())
 
+    def _candidates(self, players, top, threshold):
+        """Engine and players to pick the recommended matches from"""
+
+        # TODO: unbeaten, overlap, fewer matches, clustering
+        ids = self._all_ids(players)
+        engine = MatchEngine(self)
+
+        ranked = ranking = self._ranked(ids)
+        elos = self._elos[ranking]
+
+        # unbeaten
+        unbeaten = self._unbeaten[ranking] & (elos < elos[0])
+        if unbeaten.any():
+            ranking = ranking[unbeaten]
+
+        # neglected players
+        games = self._games[ids]
+        most_games = games.max()
+        if games.min() < most_games * 0.50:
+            neglected = games <= most_games * 0.50
+            selected = ids[neglected][np.argsort(games[neglected], kind="stable")]
+            if len(selected) == 1:
+                # alone, against the players rated next to it
+                position = int(np.flatnonzero(ranked == selected[0])[0])
+                selected = ranked[max(0, position - 1) : position + 2]
+        elif top is None:
+            selected = ranking
+        else:
+            selected = engine.neighbours(ranking[:top], ids, threshold)
+        return engine, selected
+
     def recommended_match(self, players=None, top=None, threshold=OVERLAP_THRESHOLD):
         """
         players with perfect score, that are not the first should be prioritized
@@ -141,130 +1066,284 @@ class League:
         higher k, higher probability
         closer to another player's ELO, higher probability
         """
+        engine, selected = self._candidates(players, top, threshold)
 
-        # TODO: unbeaten, overlap, fewer matches, clustering
+        # overlap
+        top_match, top_overlap = engine.best_match(selected, threshold)
+
+        if top_match is None:
+            raise RuntimeError("league perfectly sorted")
+        return sorted(self.names[index] for index in top_match), top_overlap
+
+    def recommended_matches(
+        self, players=None, top=None, threshold=OVERLAP_THRESHOLD, k=1
+    ):
+        """
+        Up to k recommended matches, no player in more than one, so they can
+        be played at once. The first one is recommended_match().
+        """
+        engine, selected = self._candidates(players, top, threshold)
+        matches = engine.best_matches(selected, threshold, k)
+        if not matches:
+            raise RuntimeError("league perfectly sorted")
+        return [
+            (sorted(self.names[index] for index in match), overlap)
+            for match, overlap in matches
+        ]
+
+
+class LeagueColumns:
+    """
+    Read-only ranking of a league, mmapped from the file written next to
+    its snapshot, so queries only read the pages they touch: top(n) a few
+    entries of each column, rank_of(player) a binary search over the names.
+    """
+
+    __slots__ = (
+        "epoch",
+        "journal_size",
+        "size",
+        "_map",
+        "_offsets",
+        "_elos",
+        "_order",
+        "_ranks",
+        "_by_name",
+        "_games",
+        "_names",
+    )
+
+    def __init__(self, path):
+        import mmap
+        import struct
+
+        with open(path, "rb") as file:
+            self._map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, self.epoch, self.journal_size, self.size, length = struct.unpack_from(
+            COLUMNS_HEADER, self._map
+        )
+        if magic != COLUMNS_MAGIC:
+            raise ValueError(f"{path} is not a league columns file")
+        offset = struct.calcsize(COLUMNS_HEADER)
+        columns = []
+        for dtype, count in (
+            ("<i8", self.size + 1),
+            ("<f8", self.size),
+            ("<i8", self.size),
+            ("<i8", self.size),
+            ("<i8", self.size),
+            ("<i8", self.size),
+        ):
+            columns.append(np.frombuffer(self._map, dtype, count, offset))
+            offset += 8 * count
+        self._offsets, self._elos, self._order, self._ranks = columns[:4]
+        self._by_name, self._games = columns[4:]
+        self._names = offset
+
+    @classmethod
+    def load(cls, name):
+        """
+        Columns of the league, or None if the journal is not the one they
+        were written up to: results were journaled after them, or the league
+        was compacted or replaced.
+        """
+        path = Path(LEAGUES_FOLDER) / (name or "default")
+        columns = cls(_columns_path(path))
+        try:
+            with open(_journal_path(path), "rb") as file:
+                header = json.loads(file.readline())
+                size = os.fstat(file.fileno()).st_size
+        except FileNotFoundError:
+            header, size = {}, None
+        if header.get("epoch") != columns.epoch or size != columns.journal_size:
+            columns.close()
+            return None
+        return columns
+
+    def close(self):
+        # the columns are views of the map, which cannot close under them
+        self._offsets = self._elos = self._order = self._ranks = None
+        self._by_name = self._games = None
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _name(self, player):
+        start = self._names + int(self._offsets[player])
+        return self._map[start : self._names + int(self._offsets[player + 1])]
+
+    def _id(self, player):
+        encoded = player.encode()
+        low, high = 0, self.size
+        while low < high:
+            middle = (low + high) // 2
+            if self._name(int(self._by_name[middle])) < encoded:
+                low = middle + 1
+            else:
+                high = middle
+        if low < self.size:
+            index = int(self._by_name[low])
+            if self._name(index) == encoded:
+                return index
+        raise KeyError(player)
+
+    def _ranked(self, players=None):
         if players is None:
-            players = set(self.elos.keys())
-        else:
-            players = set(players)
+            return self._order
+        ids = np.unique(np.fromiter(map(self._id, players), dtype=np.intp))
+        return ids[np.argsort(self._ranks[ids])]
 
-        ranking = self.get_ranking(players)
-        top_elo = ranking[0][0]
-        top_players = {
-            rank[1] for rank in takewhile(lambda rank: rank[0] == top_elo, ranking)
-        }
+    def _with_names(self, ids):
+        return [
+            (float(self._elos[index]), self._name(index).decode())
+            for index in ids.tolist()
+        ]
 
-        # unbeaten
-        unbeaten_players = (players & self.perfect_score_players) - top_players
-        if unbeaten_players:
-            ranking = self.get_ranking(unbeaten_players)
+    def get_ranking(self, players=None) -> list[tuple[float, str]]:
+        return self._with_names(self._ranked(players))
 
-        # neglected players
-        games_played = self.get_games_played(players)
-        fewer_games = games_played[0][0]
-        most_games = games_played[-1][0]
-        if fewer_games < most_games * 0.50:
-            selected = [
-                player
-                for games, player in games_played
-                if games <= most_games * 0.50
-            ]
-        elif top is None:
-            selected = [rank[1] for rank in ranking]
-        else:
-            selected = set()
-            for player in (rank[1] for rank in ranking[:top]):
-                norm_dist = self._get_norm_dist(player)
-                for other_player in players:
-                    if other_player == player:
-                        continue
-                    other_norm_dist = self._get_norm_dist(other_player)
-                    overlap = norm_dist.overlap(other_norm_dist)
-                    if overlap > threshold:
-                        selected.add(other_player)
-            selected = list(selected)
+    def top(self, n, players=None) -> list[tuple[float, str]]:
+        """first n of get_ranking(players)"""
+        return self._with_names(self._ranked(players)[:n])
 
-        # overlap
-        top_overlap = 0
-        top_match = None
-        max_lenght = min(len(selected), 3)
-        for lenght in range(2, max_lenght + 1):
-            for group in (
-                selected[f : f + lenght] for f in range(len(selected) - lenght + 1)
-            ):
-                for left, right in combinations(group, 2):
-                    dist_left = self._get_norm_dist(left)
-                    dist_right = self._get_norm_dist(right)
-                    overlap = dist_left.overlap(dist_right)
-                    if overlap > top_overlap:
-                        top_overlap = overlap
-                        top_match = (left, right)
-            if top_overlap > threshold:
-                break
+    def rank_of(self, player) -> int:
+        """position of player in get_ranking(), starting at 1"""
+        return int(self._ranks[self._id(player)]) + 1
 
-        # # closest
-        # top_overlap = float("inf")
-        # top_match = None
-        # for player in selected:
-        #     elo_player = self.elos[player]
-        #     for elo_opponent, opponent in ranking:
-        #         if opponent == player:
-        #             continue
-        #         diff = abs(elo_player - elo_opponent)
-        #         if diff < top_overlap:
-        #             top_overlap = diff
-        #             top_match = (player, opponent)
+    def games_of(self, player) -> int:
+        return int(self._games[self._id(player)])
 
-        if top_match is None:
-            raise RuntimeError("league perfectly sorted")
-        return sorted(top_match), top_overlap
+    def __len__(self):
+        return self.size
+
+    def __repr__(self):
+        return "\n".join(f"{player} ({elo})" for elo, player in self.get_ranking())
 
 
-def elo_sorted(players, league_name=None, top=None, limit=None, key=None, minimum=0):
-    players = set(players)
+def open_ranking(name):
+    """
+    League to read rankings from: its columns if they are up to date with
+    its journal, the whole league otherwise.
+    """
+    try:
+        columns = LeagueColumns.load(name)
+    except FileNotFoundError:
+        columns = None
+    return League.load(name) if columns is None else columns
+
+
+class _KeyCache(dict):
+    """player -> key(player), computed the first time it is needed"""
+
+    def __init__(self, key):
+        self.key = key
+
+    def __missing__(self, player):
+        value = self[player] = self.key(player)
+        return value
+
+
+def _precompute_keys(players, key, executor, workers=None):
+    if executor not in EXECUTORS:
+        raise ValueError(f"executor must be one of {', '.join(EXECUTORS)}")
+    players = list(players)
+    chunksize = max(1, len(players) // (4 * (workers or os.cpu_count() or 1)))
+    import concurrent.futures
+
+    pool = getattr(concurrent.futures, EXECUTORS[executor])(max_workers=workers)
+    with pool:
+        return dict(zip(players, pool.map(key, players, chunksize=chunksize)))
+
+
+def elo_sorted(
+    players,
+    league_name=None,
+    top=None,
+    limit=None,
+    key=None,
+    minimum=0,
+    batch_size=1,
+    executor=None,
+    workers=None,
+    backend="elo",
+):
+    """
+    The key of each player is computed once. With executor ("thread" or
+    "process") the keys of all players are computed concurrently, by up to
+    workers workers, before the first match.
+
+    batch_size matches without common players are recommended at once, and
+    all of them are played before asking for more. With a backend rating
+    in periods, like "glicko2", each batch is a rating period.
+
+    backend is only used if the league has to be created.
+    """
+    players = list(dict.fromkeys(players))  # in a fixed order, unlike a set
+    if key is None:
+        keys = dict(zip(players, players))
+    elif executor is None:
+        keys = _KeyCache(key)
+    else:
+        keys = _precompute_keys(players, key, executor, workers)
     top = len(players) if top is None else top
     if limit is None:
         print(f"{len(players)=}")
         limit = ceil(len(players) * log(len(players)))
     limit = max(limit, minimum)
-    league = League.load(league_name, create=True)
+    league = League.load(league_name, create=True, backend=backend)
     league.add_players(players)
     threshold = 0
-    for step in range(limit):
+    step = 0
+    while step < limit:
         if step >= minimum:
             threshold = OVERLAP_THRESHOLD
         try:
-            match, overlap = league.recommended_match(
-                top=top, players=players, threshold=threshold
+            matches = league.recommended_matches(
+                top=top,
+                players=players,
+                threshold=threshold,
+                k=min(batch_size, limit - step),
             )
         except RuntimeError:
             break
-        white, black = match
-        if key is not None:
-            k_white = key(white)
-            k_black = key(black)
-        else:
-            k_white = white
-            k_black = black
         try:
-            if k_white < k_black:
-                league.add_result(white, ">", black)
-            else:
-                league.add_result(white, "<", black)
+            for (white, black), overlap in matches:
+                if keys[white] < keys[black]:
+                    league.add_result(white, ">", black)
+                else:
+                    league.add_result(white, "<", black)
+                step += 1
         except KeyboardInterrupt:
             break
+        finally:
+            league.end_period()
     league.save()
     return [player for _, player in league.get_ranking(players)]
 
 
-@click.command()
-@click.argument("league_name", type=str)
-@click.argument("players_file", type=click.File("r"), default=sys.stdin)
-@click.option("-t", "--top", type=int)
-@click.option("-l", "--limit", type=int)
-def main(league_name, top, limit, players_file):
-    players = [player.strip() for player in players_file.readlines()]
-    print("\n".join(elo_sorted(players, league_name, top, limit)))
+def main(arguments=None):
+    # click is only needed when running as a script
+    import click
+
+    @click.command()
+    @click.argument("league_name", type=str)
+    @click.argument("players_file", type=click.File("r"), default=sys.stdin)
+    @click.option("-t", "--top", type=int)
+    @click.option("-l", "--limit", type=int)
+    @click.option("-b", "--batch-size", type=int, default=1)
+    @click.option("--backend", type=click.Choice(list(BACKENDS)), default="elo")
+    def command(league_name, top, limit, players_file, batch_size, backend):
+        players = [player.strip() for player in players_file.readlines()]
+        ranking = elo_sorted(
+            players, league_name, top, limit, batch_size=batch_size, backend=backend
+        )
+        print("\n".join(ranking))
+
+    command(arguments)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,255 @@
+#!/usr/bin/env python
+"""
+elo_sort leagues kept in memory by a long running server, so every call
+from an editor macro costs a round trip over a unix socket instead of a
+python start, a league load and a save.
+
+    elo_sortd.py serve
+    elo_sortd.py add LEAGUE WHITE RELATION BLACK
+    elo_sortd.py recommend LEAGUE [K] [TOP] < players
+    elo_sortd.py ranking LEAGUE [N] < players
+
+recommend and ranking read the players to consider from stdin, when it is
+not a terminal; all players in the league otherwise. Without a server
+running, the client does the same work in-process.
+
+The protocol is one JSON object per line each way:
+{"command": ..., **arguments} -> {"result": ...} or {"error": ...}
+"""
+
+import json
+import os
+import socket
+import sys
+
+SOCKET_PATH = os.environ.get(
+    "ELO_SORTD_SOCKET", os.path.expanduser("~/.elo_sort/elo_sortd.sock")
+)
+FLUSH_INTERVAL = 5  # seconds between background saves of the dirty leagues
+
+
+class Leagues:
+    """Loaded leagues by name, and the handlers of each command"""
+
+    def __init__(self):
+        # only the server side needs numpy and co.
+        if __package__:
+            from . import elo_sort
+        else:
+            import elo_sort
+
+        self.elo_sort = elo_sort
+        self.leagues = {}
+        self.dirty = set()
+
+    def get(self, name):
+        if name not in self.leagues:
+            self.leagues[name] = self.elo_sort.League.load(name, create=True)
+        return self.leagues[name]
+
+    def handle(self, command, league, **arguments):
+        handler = getattr(self, f"do_{command}", None)
+        if handler is None:
+            raise ValueError(f"unknown command {command!r}")
+        if (
+            command in ("ranking", "rank_of")
+            and not arguments.get("players")
+            and league not in self.leagues
+        ):
+            # nothing to write: the mmapped columns of the snapshot will do
+            try:
+                columns = self.elo_sort.LeagueColumns.load(league)
+            except FileNotFoundError:
+                columns = None
+            if columns is not None:
+                with columns:
+                    return handler(columns, **arguments)
+        return handler(self.get(league), **arguments)
+
+    def do_add_players(self, league, players):
+        league.add_players(players)
+        self.dirty.add(league)
+
+    def do_add_result(self, league, white, relation, black):
+        league.add_players([white, black])
+        league.add_result(white, relation, black)
+        self.dirty.add(league)
+
+    def do_recommend(self, league, players=None, top=None, k=1):
+        if players:
+            league.add_players(players)
+            self.dirty.add(league)
+        return league.recommended_matches(players=players or None, top=top, k=k)
+
+    def do_ranking(self, league, players=None, n=None):
+        if n is None:
+            return league.get_ranking(players or None)
+        return league.top(n, players or None)
+
+    def do_rank_of(self, league, player):
+        return league.rank_of(player)
+
+    def flush(self):
+        while self.dirty:
+            league = self.dirty.pop()
+            league.end_period()  # each flush interval is a rating period
+            league.save()
+
+    def close(self):
+        self.flush()
+        for league in self.leagues.values():
+            league.close()
+
+
+def make_server(path=None):
+    """
+    Threaded unix socket server over a Leagues, listening on path
+    (SOCKET_PATH by default). Requests are served one at a time, a
+    background thread saves the dirty leagues every FLUSH_INTERVAL seconds.
+    """
+    path = path or SOCKET_PATH
+    import socketserver
+    import threading
+
+    leagues = Leagues()
+    lock = threading.Lock()
+
+    class Handler(socketserver.StreamRequestHandler):
+        def handle(self):
+            for line in self.rfile:
+                try:
+                    request = json.loads(line)
+                    with lock:
+                        response = {"result": leagues.handle(**request)}
+                except Exception as error:
+                    response = {"error": f"{type(error).__name__}: {error}"}
+                self.wfile.write(json.dumps(response).encode() + b"\n")
+
+    class Server(socketserver.ThreadingUnixStreamServer):
+        daemon_threads = True
+
+        def server_bind(self):
+            # created 0600: no moment when others could connect
+            umask = os.umask(0o177)
+            try:
+                super().server_bind()
+            finally:
+                os.umask(umask)
+
+        def server_activate(self):
+            super().server_activate()
+            self.stopped = threading.Event()
+            threading.Thread(target=self.flush_forever, daemon=True).start()
+
+        def flush_forever(self):
+            while not self.stopped.wait(FLUSH_INTERVAL):
+                with lock:
+                    leagues.flush()
+
+        def server_close(self):
+            self.stopped.set()
+            super().server_close()
+            with lock:
+                leagues.close()
+            os.unlink(self.server_address)
+
+    if os.path.exists(path):
+        try:
+            Client(path).close()
+        except ConnectionRefusedError:
+            os.unlink(path)  # left behind by a server that died
+        else:
+            raise RuntimeError(f"a server is already listening on {path}")
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    return Server(path, Handler)
+
+
+def serve(path=None):
+    import signal
+
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+    with make_server(path) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+
+
+class Client:
+    """One connection to the server, for any number of requests"""
+
+    def __init__(self, path=None):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.connection.connect(path or SOCKET_PATH)
+        except OSError:
+            self.connection.close()
+            raise
+        self.stream = self.connection.makefile("rb")
+
+    def request(self, command, **arguments):
+        message = json.dumps({"command": command, **arguments}).encode() + b"\n"
+        self.connection.sendall(message)
+        response = json.loads(self.stream.readline())
+        if "error" in response:
+            raise RuntimeError(response["error"])
+        return response["result"]
+
+    def close(self):
+        self.stream.close()
+        self.connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def request(command, **arguments):
+    """Ask the server, or do it here if there is none listening."""
+    try:
+        client = Client()
+    except (FileNotFoundError, ConnectionRefusedError):
+        leagues = Leagues()
+        try:
+            result = leagues.handle(command, **arguments)
+        finally:
+            leagues.close()
+        return json.loads(json.dumps(result))
+    with client:
+        return client.request(command, **arguments)
+
+
+def read_players():
+    if sys.stdin.isatty():
+        return None
+    return [player.strip() for player in sys.stdin if player.strip()] or None
+
+
+def main(arguments):
+    if arguments[:1] == ["serve"]:
+        serve()
+    elif arguments[:1] == ["add"] and len(arguments) == 5:
+        league, white, relation, black = arguments[1:]
+        request(
+            "add_result", league=league, white=white, relation=relation, black=black
+        )
+    elif arguments[:1] == ["recommend"] and 2 <= len(arguments) <= 4:
+        k = int(arguments[2]) if len(arguments) > 2 else 1
+        top = int(arguments[3]) if len(arguments) > 3 else None
+        matches = request(
+            "recommend", league=arguments[1], players=read_players(), k=k, top=top
+        )
+        for match, _ in matches:
+            print("\t".join(match))
+    elif arguments[:1] == ["ranking"] and 2 <= len(arguments) <= 3:
+        n = int(arguments[2]) if len(arguments) == 3 else None
+        ranking = request("ranking", league=arguments[1], players=read_players(), n=n)
+        print("\n".join(player for _, player in ranking))
+    else:
+        sys.exit(__doc__)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,130 +1,257 @@
-#!/usr/bin/python
+#!/usr/bin/env python
 # -*- coding: UTF-8 -*-
-from math import sqrt
-from sys import argv, exit, stdin, stderr
-from subprocess import Popen, PIPE
-from os import environ
-import cPickle
-import time
-import psyco
-
-debug = False
-
-if debug:
-    inicio = time.time()
-
-ruta = environ["HOME"] + "/.primos.pickle"
-
-try:
-    archivo = open(ruta, "r")
-    criba = cPickle.load(archivo)
-    archivo.close()
-
-except EOFError:
-    criba = None 
-    archivo.close()
-
-except IOError:
-    criba = None
-
-if debug:
-    stderr.write(("%9.5f" % (time.time() - inicio) + " pickle abierto\n"))
-
-def cribar(hasta, criba=None):
-    if debug:
-        stderr.write(("%9.5f" % (time.time() - inicio) + "   Iniciada\n"))
-
-    criba = criba or [False, False, True, True, False, True, False, True]
-
-    if hasta < len(criba):
-        return criba[:hasta + 1]
-
-    if debug:
-        stderr.write(("%9.5f" % (time.time() - inicio) + "   Extendiendo\n"))
-
-    desde = len(criba) + 1
-    criba.extend([True] * (hasta - desde + 2))
-    #print len(criba), criba[hasta]
-
-    if debug:
-        stderr.write(("%9.5f" % (time.time() - inicio) + "   Criba extendida\n"))
-
-    for primo in [N for N in xrange(int(sqrt(hasta + 1)) + 1) if criba[N]]:
-        for multiplo in xrange(max(desde / primo, 2), hasta / primo + 1):
-            #[N for N in xrange(desde / primo, hasta / primo + 1) if criba[N]]
-            #print primo, multiplo, primo * multiplo
-
-                criba[primo * multiplo] = False
-
-                #FIXME: cribar_awk va mucho mas rapido pero no aprovecha el calculo previo
-                #criba = cribar_awk(hasta)
-
-        if debug:
-            stderr.write(("%9.5f" % (time.time() - inicio) + "   Criba renormalizada\n"))
-
-        archivo = open(ruta, "w")
-        cPickle.dump(criba, archivo, -1)
-        archivo.close()
-
-        if debug:
-            stderr.write(("%9.5f" % (time.time() - inicio) + "   Criba guardada\n"))
-
-    print time.time() - inicio
+"""
+Criba de Eratóstenes segmentada y reanudable.
+
+La criba se guarda en RUTA, un bit por número impar: el bit j del byte k
+vale 1 si 16 k + 2 j + 1 es primo. Extenderla hasta un número nuevo sólo
+criba lo que falta desde el final del archivo, en segmentos de SEGMENTO
+números, y añade cada segmento al archivo una única vez. Si el proceso se
+interrumpe, lo escrito sigue siendo válido y se continúa desde ahí. Las
+consultas leen el archivo con mmap, así que sólo tocan las páginas que
+necesitan.
+
+    primos.py [hasta]
+"""
+
+from bisect import bisect_left, bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from math import isqrt
+from subprocess import PIPE, Popen
+from sys import argv, exit
+import ast
+import fcntl
+import mmap
+import os
+import shutil
+
+import numpy as np
+
+RUTA = os.path.join(os.environ.get("HOME", "."), ".primos.bits")
+SEGMENTO = 2**20  # números por segmento: 512 KiB sin empaquetar, 64 KiB en disco
+NUMEROS_POR_BYTE = 16
+
+
+def primos_base(hasta):
+    """Criba simple en memoria, para los primos hasta la raíz del límite"""
+    criba = bytearray([1]) * (hasta + 1)
+    criba[: min(2, hasta + 1)] = bytes(min(2, hasta + 1))
+    for primo in range(2, isqrt(hasta) + 1):
+        if criba[primo]:
+            criba[primo * primo :: primo] = bytes(
+                len(range(primo * primo, hasta + 1, primo))
+            )
+    return [numero for numero in range(hasta + 1) if criba[numero]]
+
+
+def cribar_segmento(desde, hasta, base):
+    """
+    Los bytes de la criba de los números de desde a hasta (sin incluir),
+    ambos múltiplos de 16, con base los primos hasta la raíz de hasta - 1
+    por lo menos.
+    """
+    impares = np.ones((hasta - desde) // 2, dtype=bool)  # desde + 2 i + 1
+    if desde == 0:
+        impares[0] = False
+    for primo in base[1:]:
+        cuadrado = primo * primo
+        if cuadrado >= hasta:
+            break
+        multiplo = max(cuadrado, -(-(desde + 1) // primo) * primo)
+        if not multiplo % 2:
+            multiplo += primo
+        impares[(multiplo - desde) // 2 :: primo] = False
+    return np.packbits(impares, bitorder="little").tobytes()
+
+
+def cribar(hasta, ruta=RUTA, segmento=SEGMENTO, procesos=1):
+    """
+    Extiende la criba guardada en ruta hasta hasta, segmento a segmento, y
+    devuelve cuántos números cubre. Con más de un proceso los segmentos se
+    reparten entre ellos, y el resultado es el mismo.
+    """
+    segmento = max(segmento // NUMEROS_POR_BYTE, 1) * NUMEROS_POR_BYTE
+    with open(ruta, "ab") as archivo:
+        # de un proceso a la vez, y desde donde lo haya dejado el anterior
+        fcntl.flock(archivo, fcntl.LOCK_EX)
+        desde = archivo.seek(0, os.SEEK_END) * NUMEROS_POR_BYTE
+        if desde > hasta:
+            return desde
+        tope = (hasta // NUMEROS_POR_BYTE + 1) * NUMEROS_POR_BYTE
+        base = primos_base(isqrt(tope))
+        if procesos > 1 and tope - desde > segmento:
+            # bajo el bloqueo de ruta: basta un archivo parcial por criba
+            parcial = os.fspath(ruta) + ".parcial"
+            try:
+                _cribar_en_paralelo(parcial, desde, tope, base, segmento, procesos)
+                with open(parcial, "rb") as copia:
+                    shutil.copyfileobj(copia, archivo)
+            finally:
+                if os.path.exists(parcial):
+                    os.remove(parcial)
+            return tope
+        while desde < tope:
+            limite = min(desde + segmento, tope)
+            archivo.write(cribar_segmento(desde, limite, base))
+            archivo.flush()
+            desde = limite
+    return desde
+
+
+def _cribar_en_paralelo(parcial, desde, tope, base, segmento, procesos):
+    """
+    Criba de desde a tope en el archivo parcial, mapeado en memoria por
+    cada uno de los procesos, que escriben sus segmentos en su sitio.
+    """
+    with open(parcial, "wb") as archivo:
+        archivo.truncate((tope - desde) // NUMEROS_POR_BYTE)
+    comienzos = range(desde, tope, segmento)
+    with ProcessPoolExecutor(
+        procesos, initializer=_iniciar_proceso, initargs=(parcial, desde, base)
+    ) as ejecutor:
+        for _ in ejecutor.map(
+            _cribar_en_mapa,
+            comienzos,
+            [min(comienzo + segmento, tope) for comienzo in comienzos],
+        ):
+            pass
+
+
+_proceso = {}  # el mapa, su comienzo y la base de cada proceso de la criba
+
+
+def _iniciar_proceso(parcial, desde, base):
+    with open(parcial, "r+b") as archivo:
+        _proceso["mapa"] = mmap.mmap(archivo.fileno(), 0)
+    _proceso["desde"] = desde
+    _proceso["base"] = base
+
+
+def _cribar_en_mapa(desde, hasta):
+    inicio = (desde - _proceso["desde"]) // NUMEROS_POR_BYTE
+    bits = cribar_segmento(desde, hasta, _proceso["base"])
+    _proceso["mapa"][inicio : inicio + len(bits)] = bits
+
+
+class Tabla:
+    """
+    La criba de un archivo, mapeada en memoria: abrirla no lee nada, y cada
+    consulta lee sólo los bytes que le tocan.
+    """
+
+    def __init__(self, ruta=RUTA):
+        with open(ruta, "rb") as archivo:
+            tamano = os.fstat(archivo.fileno()).st_size
+            self._mapa = None  # un archivo vacío no se puede mapear
+            if tamano:
+                self._mapa = mmap.mmap(archivo.fileno(), 0, access=mmap.ACCESS_READ)
+        self.cubre = tamano * NUMEROS_POR_BYTE
+
+    def es_primo(self, numero):
+        if numero < 2:
+            return False
+        if numero >= self.cubre:
+            raise IndexError(f"la criba sólo llega hasta {self.cubre - 1}")
+        if numero % 2 == 0:
+            return numero == 2
+        indice, bit = divmod(numero // 2, 8)
+        return bool(self._mapa[indice] >> bit & 1)
+
+    def primos(self, desde, hasta, segmento=SEGMENTO):
+        """Los primos entre desde y hasta, incluidos"""
+        if hasta >= self.cubre:
+            raise IndexError(f"la criba sólo llega hasta {self.cubre - 1}")
+        desde = max(desde, 0)
+        if desde <= 2 <= hasta:
+            yield 2
+        bytes_por_trozo = max(segmento // NUMEROS_POR_BYTE, 1)
+        inicio = desde // NUMEROS_POR_BYTE
+        fin = hasta // NUMEROS_POR_BYTE + 1
+        for trozo in range(inicio, fin, bytes_por_trozo):
+            bits = np.unpackbits(
+                np.frombuffer(
+                    self._mapa,
+                    np.uint8,
+                    min(bytes_por_trozo, fin - trozo),
+                    trozo,
+                ),
+                bitorder="little",
+            )
+            numeros = np.flatnonzero(bits) * 2 + (trozo * NUMEROS_POR_BYTE + 1)
+            if trozo == inicio or trozo + bytes_por_trozo >= fin:
+                numeros = numeros[(numeros >= desde) & (numeros <= hasta)]
+            yield from numeros.tolist()
+
+    def close(self):
+        if self._mapa is not None:
+            self._mapa.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+_TABLAS = {}  # ruta -> la última Tabla abierta de ruta
+
+
+def tabla(hasta, ruta=RUTA, segmento=SEGMENTO):
+    """
+    Una Tabla de ruta que llegue hasta hasta. Se abre una vez y se reutiliza
+    para todas las consultas, y sólo se extiende la criba, y se vuelve a
+    abrir, cuando no llega.
+    """
+    ruta = os.fspath(ruta)
+    abierta = _TABLAS.get(ruta)
+    if abierta is None or hasta >= abierta.cubre:
+        # quizá otro proceso ya la extendió, y basta con leerla
+        abierta = Tabla(ruta) if os.path.exists(ruta) else None
+        if abierta is None or hasta >= abierta.cubre:
+            cribar(hasta, ruta, segmento)
+            abierta = Tabla(ruta)
+        # la anterior se cierra sola cuando nadie la use
+        _TABLAS[ruta] = abierta
+    return abierta
+
+
+def es_primo(numero, ruta=RUTA):
+    if numero < 2:
+        return False
+    return tabla(numero, ruta).es_primo(numero)
+
+
+def primos(desde, hasta, ruta=RUTA, segmento=SEGMENTO):
+    """Los primos entre desde y hasta, incluidos, leídos de la criba"""
+    return tabla(hasta, ruta, segmento).primos(desde, hasta, segmento)
 
-    return criba
 
 def cribar_awk(hasta):
-    subproceso = Popen("primos.awk " + `hasta`,\
-    shell=True, stdout=PIPE, stderr=PIPE)
-    exec("criba = " + subproceso.stdout.readlines()[0])
-    return criba
+    subproceso = Popen(["primos.awk", str(hasta)], stdout=PIPE, stderr=PIPE, text=True)
+    return ast.literal_eval(subproceso.stdout.readline())
 
-def porcion(lista, minimo, maximo):
-    return [elemento for elemento in lista if minimo <= elemento <= maximo]
-    #FIXME: Aqui deberia hacerse una busqueda binaria
 
-# # # MAIN # # #
-if __name__ == "__main__":
+def porcion(lista, minimo, maximo):
+    """Los elementos de lista, ordenada, entre minimo y maximo"""
+    return lista[bisect_left(lista, minimo) : bisect_right(lista, maximo)]
 
-    if debug:
-        stderr.write(("%9.5f" % (time.time() - inicio) + " main\n"))
 
-    if len(argv) > 2:
-        print """Decidase por un numero, por favor."""
+def main(argumentos):
+    if len(argumentos) > 1:
+        print("Decídase por un número, por favor.")
         exit(2)
+    if argumentos:
+        try:
+            hasta = int(argumentos[0])
+        except ValueError:
+            print("Estamos hablando de números primos. ¡¡NÚMEROS!!")
+            exit(3)
     else:
-        if len(argv) == 2:
-            try:
-                hasta = int(argv[1])
-            except ValueError:
-                print """Estamos hablando de numeros primos. NUMEROS!!"""
-                exit(3)
-        else:
-            print """No se especifico ningun limite,\
-            se buscaran los primos hasta 1000."""
-            hasta = 1000
+        print("No se especificó ningún límite, se buscarán los primos hasta 1000.")
+        hasta = 1000
+    cribar(hasta, procesos=os.cpu_count() or 1)
+    print(sum(primos(0, hasta)))
 
-    if debug:
-        stderr.write(("%9.5f" % (time.time() - inicio) + " > cribar(n)\n"))
 
-    criba = cribar(hasta, criba)
-
-    if debug:
-        stderr.write(("%9.5f" % (time.time() - inicio) + " < cribar(n)\n"))
-
-    total = 0
-
-    for primo in [N for N in xrange(len(criba)) if criba[N]]:
-#        print primo
-        total += primo
-
-    print total
-
-    if debug:
-        stderr.write(("%9.5f" % (time.time() - inicio) + " Primos mostrados\n"))
-
-else:
-    print "Modulo de criba:", dir()
-
-if debug:
-    stderr.write(("%9.5f" % (time.time() - inicio) + " FIN\n"))
+if __name__ == "__main__":
+    main(argv[1:])
@@ -2,6 +2,7 @@
 # /// script
 # requires-python = ">=3.13"
 # dependencies = [
+#     "numpy",
 #     "trueskillthroughtime",
 # ]
 # ///
@@ -36,144 +37,772 @@
     time and effort.
 """
 
-from math import ceil, log, sqrt
+from contextlib import nullcontext
+from math import ceil, erfc, exp, inf, log, pi, sqrt
 from itertools import combinations
+from pathlib import Path
+from statistics import NormalDist
+import copyreg
+import gc
+import heapq
+import json
+import os
+import pickle
+
+import numpy as np
+from trueskillthroughtime import Agent, Batch, BETA, EPSILON, Gaussian, History, MU
+from trueskillthroughtime import Ninf, SIGMA
+from trueskillthroughtime import cdf, Player, Game
+
+DEFAULT_MU = MU  # of players without games, the prior of the model
+DEFAULT_SIGMA = SIGMA
+DECAY_RATE = 0.05  # Soft pull toward prior
+SWEEPS = 30  # max smoothing passes over the games of the players of a new game
+LEAGUES_FOLDER = os.path.expanduser("~/.tstt_sort/leagues/")
+CONTENDING = 2.0  # deviations below the last of the top players still compared
 
-from trueskillthroughtime import History, cdf, Player, Game
 
+def approximate_evoi(mu_left, sigma_left, mu_right, sigma_right):
+    """
+    Expected reduction of the total variance by one TrueSkill update of a
+    game between two players, the only two whose variance it changes.
+
+    If left wins, both variances shrink by sigma**4 / c**2 * w(t), with
+    t = (mu_left - mu_right) / c, c**2 = 2 * BETA**2 + sigma_left**2 +
+    sigma_right**2 and w(t) = v(t) * (v(t) + t), v(t) = pdf(t) / cdf(t); if
+    right wins, by the same with -t. Weighted by the chances of each result
+    that is (sigma_left**4 + sigma_right**4) / c**2 * pdf(t)**2 /
+    (cdf(t) * cdf(-t)).
+    """
+    variance = 2 * BETA * BETA + sigma_left * sigma_left + sigma_right * sigma_right
+    t = (mu_left - mu_right) / sqrt(variance)
+    chances = erfc(-t / sqrt(2)) * erfc(t / sqrt(2)) / 4
+    if chances == 0:
+        return 0.0
+    density = exp(-t * t / 2) / sqrt(2 * pi)
+    return (sigma_left**4 + sigma_right**4) / variance * density * density / chances
+
+
+def _erfcc(x):
+    """
+    Vectorized math.erfc to a relative 1.2e-7, tails included (Numerical
+    Recipes' erfcc). elo_sort.erfc_array is closer in absolute terms, but 0
+    past 6, which would zero the chances of the less likely results.
+    """
+    x = np.asarray(x, dtype=float)
+    z = np.abs(x)
+    t = 1 / (1 + z / 2)
+    polynomial = 0.17087277
+    for coefficient in (
+        -0.82215223,
+        1.48851587,
+        -1.13520398,
+        0.27886807,
+        -0.18628806,
+        0.09678418,
+        0.37409196,
+        1.00002368,
+        -1.26551223,
+    ):
+        polynomial = coefficient + t * polynomial
+    result = t * np.exp(-z * z + polynomial)
+    return np.where(x < 0, 2 - result, result)
+
+
+def approximate_evoi_array(mu_left, sigma_left, mu_right, sigma_right):
+    """Vectorized approximate_evoi"""
+    variance = 2 * BETA * BETA + sigma_left * sigma_left + sigma_right * sigma_right
+    t = (mu_left - mu_right) / np.sqrt(variance)
+    chances = _erfcc(-t / sqrt(2)) * _erfcc(t / sqrt(2)) / 4
+    density = np.exp(-t * t / 2) / sqrt(2 * pi)
+    evoi = (sigma_left**4 + sigma_right**4) / variance * density * density
+    return np.divide(evoi, chances, out=np.zeros_like(evoi), where=chances > 0)
+
+
+def _best_first(scores, m):
+    """Indices of the m best scores, best first, the first of equals first"""
+    if m < len(scores):
+        candidates = np.flatnonzero(scores >= np.partition(scores, -m)[-m])
+    else:
+        candidates = np.arange(len(scores))
+    return candidates[np.argsort(-scores[candidates], kind="stable")][:m]
+
+
+def simulated_variances(matches, players, left, right):
+    """
+    Total variance of players converging the whole history of matches plus
+    left beating right, and plus right beating left.
+    """
+    composition = [[[winner], [loser]] for winner, loser in matches]
+    variances = []
+    for game in ([[left], [right]], [[right], [left]]):
+        history = History(composition + [game], [[1, 0]] * (len(composition) + 1))
+        history.convergence(verbose=False)
+        curves = history.learning_curves()
+        variances.append(
+            sum(
+                (curves[player][-1][1].sigma if player in curves else SIGMA) ** 2
+                for player in players
+            )
+        )
+    return tuple(variances)
+
+
+_WORKER_LEAGUE = None  # (matches, players) of the league, in each pool process
+
+
+def _set_worker_league(matches, players):
+    global _WORKER_LEAGUE
+    _WORKER_LEAGUE = (matches, players)
+
+
+def _worker_variances(pair):
+    return simulated_variances(*_WORKER_LEAGUE, *pair)
+
+
+def candidate_pairs(gaussians, band=None, neighbours=None):
+    """
+    Pairs of gaussians (player -> (mu, sigma)) worth scoring: those whose
+    less likely result still has a chance of at least band, and each player
+    with its neighbours players closest in t = (mu_left - mu_right) / c, c
+    as in approximate_evoi. With both, the union; with none, all pairs.
+    Each pair is ordered as its players in gaussians, the pairs by mu.
+
+    Players are walked in mu order from each one outward, and a walk stops
+    once the difference of mu alone, over the largest c any pair of the
+    player could have, is already too far.
+    """
+    if band is not None and not 0 < band < 0.5:
+        # the less likely result is below 0.5; band 0 would keep every pair
+        raise ValueError(f"band must be between 0 and 0.5, not {band}")
+    if band is None and neighbours is None:
+        return list(combinations(gaussians, 2))
+    players = list(gaussians)
+    by_mu = sorted(range(len(players)), key=lambda index: gaussians[players[index]])
+    mus = [gaussians[players[index]][0] for index in by_mu]
+    variances = [2 * BETA * BETA + gaussians[players[index]][1] ** 2 for index in by_mu]
+    widest = max(variances) - 2 * BETA * BETA
+    reach = -inf if band is None else NormalDist().inv_cdf(1 - band)
+    kept = []  # (i, j) in mu order, i < j
+    close = set()  # of the nearest pairs not in the band
+    for i, (mu, variance) in enumerate(zip(mus, variances)):
+        limit = reach * sqrt(variance + widest)
+        j = i + 1
+        while j < len(mus) and mus[j] - mu <= limit:
+            if mus[j] - mu <= reach * sqrt(variance + variances[j] - 2 * BETA * BETA):
+                kept.append((i, j))
+            j += 1
+        if not neighbours:
+            continue
+        nearest = []  # heap of (-t, j) of the neighbours closest so far
+        for others in (range(i + 1, len(mus)), range(i - 1, -1, -1)):
+            for j in others:
+                difference = abs(mus[j] - mu)
+                if len(nearest) == neighbours and difference > -nearest[0][0] * sqrt(
+                    variance + widest
+                ):
+                    break
+                t = difference / sqrt(variance + variances[j] - 2 * BETA * BETA)
+                if len(nearest) < neighbours:
+                    heapq.heappush(nearest, (-t, j))
+                elif t < -nearest[0][0]:
+                    heapq.heapreplace(nearest, (-t, j))
+        close.update((min(i, j), max(i, j)) for t, j in nearest if -t > reach)
+    kept.extend(sorted(close))
+    pairs = []
+    for i, j in kept:
+        left, right = by_mu[i], by_mu[j]
+        if left > right:
+            left, right = right, left
+        pairs.append((players[left], players[right]))
+    return pairs
+
+
+class IncrementalHistory:
+    """
+    TrueSkillThroughTime history that grows one game at a time, each game in
+    its own batch, as History does without times.
+
+    Games already converged are kept. A new game is appended with the last
+    messages of its players, and only the games of those players are swept,
+    backward and forward, until they converge, and those of their opponents
+    once, instead of converging the whole history again.
+    The learning curve of a player is cached until a sweep touches one of
+    its games, and the player is kept in changed until the caller clears it.
+    """
+
+    def __init__(self, composition=(), results=(), iterations=None):
+        """iterations of the convergence of composition, 0 for a forward pass"""
+        self.batches: list[Batch] = []
+        self.agents: dict[str, Agent] = {}
+        self.games: dict[str, list[Batch]] = {}  # player -> batches, oldest first
+        self.curves: dict[str, list] = {}  # player -> cached learning curve
+        self.changed: set[str] = set()  # players whose posterior was touched
+        if composition:
+            history = History(composition, results)
+            if iterations is None:
+                history.convergence(verbose=False)
+            else:
+                history.convergence(iterations=iterations, verbose=False)
+            self.batches = history.batches
+            self.agents = history.agents
+            for batch in self.batches:
+                for player in batch.skills:
+                    self.games.setdefault(player, []).append(batch)
+
+    def __len__(self):
+        return len(self.batches)
+
+    def add_game(self, teams, result):
+        for player in (player for team in teams for player in team):
+            if player not in self.agents:
+                self.agents[player] = Agent(Player(Gaussian()), Ninf, -inf)
+        batch = Batch([teams], [result], len(self.batches) + 1, self.agents)
+        self.batches.append(batch)
+        for player in batch.skills:
+            self.games.setdefault(player, []).append(batch)
+            self.agents[player].last_time = inf
+            self.agents[player].message = batch.forward_prior_out(player)
+            self.curves.pop(player, None)
+            self.changed.add(player)
+        players = list(batch.skills)
+        self._converge(players)
+        opponents = {
+            opponent
+            for player in players
+            for game in self.games[player]
+            for opponent in game.skills
+        }
+        for opponent in sorted(opponents.difference(players)):
+            self._sweep(opponent)
+        self._converge(players)
+
+    def _converge(self, players):
+        for _ in range(SWEEPS):
+            old = {player: self.posterior(player) for player in players}
+            for player in players:
+                self._sweep(player)
+            step = max(
+                max(old[player].delta(self.posterior(player))) for player in players
+            )
+            if step <= EPSILON:
+                break
+
+    def _sweep(self, player):
+        """Pass messages back and forth along the games of player"""
+        games = self.games[player]
+        agent = self.agents[player]
+        touched = set()
+        message = Ninf
+        for batch in reversed(games):
+            batch.skills[player].backward = message
+            batch.iteration()
+            touched.update(batch.skills)
+            message = batch.backward_prior_out(player)
+        message = Ninf
+        for batch in games:
+            skill = batch.skills[player]
+            if message is Ninf:
+                skill.forward = agent.player.prior
+            else:
+                skill.forward = message.forget(agent.player.gamma, skill.elapsed)
+            batch.iteration()
+            message = batch.forward_prior_out(player)
+        agent.message = message
+        for touched_player in touched:
+            self.curves.pop(touched_player, None)
+        self.changed.update(touched)
+
+    def learning_curve(self, player):
+        if player not in self.curves:
+            self.curves[player] = [
+                (batch.time, batch.posterior(player))
+                for batch in self.games.get(player, ())
+            ]
+        return self.curves[player]
+
+    def posterior(self, player):
+        curve = self.learning_curve(player)
+        return curve[-1][1] if curve else None
+
+
+def _reduce_gaussian(gaussian):
+    # Ninf is told apart by identity, so it must unpickle as itself
+    if gaussian is Ninf:
+        return "Ninf"
+    return Gaussian, (gaussian.mu, gaussian.sigma)
+
+
+class _ModelPickler(pickle.Pickler):
+    dispatch_table = copyreg.dispatch_table.copy()
+    dispatch_table[Gaussian] = _reduce_gaussian
 
-DEFAULT_MU = 25.0
-DEFAULT_SIGMA = 8.333
-DECAY_RATE = 0.05  # Soft pull toward prior
+
+class _ModelUnpickler(pickle.Unpickler):
+    """Models pickled by `python tstt_sort.py` refer to __main__."""
+
+    def find_class(self, module, name):
+        if name == "IncrementalHistory":
+            return IncrementalHistory
+        return super().find_class(module, name)
+
+
+def _matches_path(path):
+    return Path(f"{path}.matches")
+
+
+def _model_path(path):
+    return Path(f"{path}.model")
+
+
+def _posteriors_path(path):
+    return Path(f"{path}.posteriors")
 
 
 class TSTTLeague:
-    def __init__(self):
+    """
+    A league on disk is an append-only log of its players and matches, one
+    JSON list per line, written as they are added, plus the model of the
+    first matches and the posteriors of its players, written by save().
+
+    Loading only reads the log, and the posteriors if the model covers all
+    matches, which is enough to rank; the model is unpickled when a pair
+    is recommended or new matches have to be added to it.
+
+    Players are interned to integer ids (their position in names), and the
+    mean and deviation of each is kept in arrays indexed by those ids,
+    updated from the model only for the players its new games touched.
+    """
+
+    def __init__(self, on_prune=None):
+        # called with (pruned, total) pairs by each recommend_pair, if set
+        self.on_prune = on_prune
         self.matches: list[tuple[str, str]] = []  # list of (winner, loser)
         self.players: set[str] = set()
-        self.skill: dict[str, tuple[float, float]] = {}  # player -> (mu, sigma)
+        self.names: list[str] = []  # player by id
+        self.ids: dict[str, int] = {}
+        self.mus = np.empty(0)  # posterior by id
+        self.sigmas = np.empty(0)
+        self.model: IncrementalHistory | None = None  # of matches, built lazily
+        self._synced = None  # model the arrays were last updated from
+        self.path: Path | None = None
+        self._log = None  # match log, open for appending
+        self._torn = None  # offset of a torn log tail, cut by the writer
+        self._saved = 0  # matches in the model on disk
+        self._posteriors = None  # player -> (mu, sigma) on disk, if up to date
+
+    @classmethod
+    def load(cls, name, create=False):
+        league = cls()
+        league.path = Path(LEAGUES_FOLDER) / (name or "default")
+        try:
+            file = open(_matches_path(league.path), "rb")
+        except FileNotFoundError:
+            if not create:
+                raise
+            return league
+        players = []
+        with file:
+            end = 0
+            for line in file:
+                if not line.endswith(b"\n"):
+                    break  # torn by a crash in the middle of a write
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    break
+                if entry[0] == "+":
+                    players.append(entry[1])
+                else:
+                    league.matches.append(tuple(entry))
+                end += len(line)
+            else:
+                end = None
+            league._torn = end
+        try:
+            with open(_posteriors_path(league.path), encoding="utf-8") as file:
+                posteriors = json.load(file)
+        except (FileNotFoundError, ValueError):
+            posteriors = {"matches": inf}
+        if posteriors["matches"] <= len(league.matches):
+            league._saved = posteriors["matches"]
+            if league._saved == len(league.matches):
+                league._posteriors = posteriors["skill"]
+        league._intern(players)
+        return league
+
+    def _write(self, *entry):
+        if self.path is None:
+            return
+        import fcntl
+
+        if __package__:
+            from .elo_sort import _cut_torn_tail
+        else:
+            from elo_sort import _cut_torn_tail
+
+        if self._log is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._log = open(_matches_path(self.path), "a", encoding="utf-8")
+        # appends and repairs exclude each other across processes, so a torn
+        # line seen under the lock is from a crash
+        fcntl.flock(self._log, fcntl.LOCK_EX)
+        try:
+            if self._torn is not None:
+                _cut_torn_tail(self._log.name, self._torn)
+                self._torn = None
+            self._log.write(json.dumps(entry) + "\n")
+            self._log.flush()
+        finally:
+            fcntl.flock(self._log, fcntl.LOCK_UN)
 
     def add_players(self, players):
+        for player in self._intern(players):
+            self._write("+", player)
+
+    def _intern(self, players):
+        """Give ids to the new players, and return them"""
+        new = []
         for player in players:
-            if player not in self.skill:
-                self.skill[player] = (DEFAULT_MU, DEFAULT_SIGMA)
-            self.players.add(player)
+            if player not in self.ids:
+                self.ids[player] = len(self.names)
+                self.names.append(player)
+                self.players.add(player)
+                new.append(player)
+        if new:
+            mus, sigmas = zip(*map(self._posterior, new))
+            self.mus = np.concatenate((self.mus, mus))
+            self.sigmas = np.concatenate((self.sigmas, sigmas))
+        return new
+
+    def _posterior(self, player):
+        """(mu, sigma) of player, in the model or the posteriors on disk"""
+        if self.model is not None:
+            posterior = self.model.posterior(player)
+            if posterior is not None:
+                return posterior.mu, posterior.sigma
+        elif self._posteriors is not None and player in self._posteriors:
+            return tuple(self._posteriors[player])
+        return DEFAULT_MU, DEFAULT_SIGMA
 
     def add_result(self, winner, loser):
         self.matches.append((winner, loser))
+        self._posteriors = None
+        self._write(winner, loser)
+
+    def save(self):
+        """
+        Matches are logged as they are added, so saving only writes the
+        model, if it is loaded and has new matches since the last save.
+        """
+        if self.path is None:
+            raise ValueError("TSTTLeague has no path or name")
+        if self.model is None or len(self._update_model()) == self._saved:
+            return
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        for path, write in (
+            (_model_path(self.path), self._write_model),
+            (_posteriors_path(self.path), self._write_posteriors),
+        ):
+            temporary = Path(f"{path}.tmp")
+            with open(temporary, "wb") as file:
+                write(file)
+            os.replace(temporary, path)
+        self._saved = len(self.model)
+
+    def _write_model(self, file):
+        _ModelPickler(file, pickle.HIGHEST_PROTOCOL).dump(self.model)
+
+    def _write_posteriors(self, file):
+        skill = {}
+        for player in self.model.agents:
+            posterior = self.model.posterior(player)
+            skill[player] = [posterior.mu, posterior.sigma]
+        posteriors = {"matches": len(self.model), "skill": skill}
+        file.write(json.dumps(posteriors).encode())
+
+    def close(self):
+        if self._log is not None:
+            self._log.close()
+            self._log = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.save()
+        self.close()
 
     def _apply_decay(self):
-        for player in self.players:
-            mu, sigma = self.skill[player]
-            mu += (DEFAULT_MU - mu) * DECAY_RATE
-            sigma += (DEFAULT_SIGMA - sigma) * DECAY_RATE
-            self.skill[player] = (mu, sigma)
-
-    def _build_model(self):
-        if not self.matches:
-            return {player: DEFAULT_MU for player in self.players}
-
-        composition, results = [], []
-        for winner, loser in self.matches:
-            composition.append([[winner], [loser]])
-            results.append([1, 0])
-
-        hist = History(composition, results)
-        hist.convergence()  # propagate information:contentReference[oaicite:1]{index=1}
-
-        means = {}
-        for player in self.players:
-            if player in hist.learning_curves() and hist.learning_curves()[player]:
-                _, gauss = hist.learning_curves()[player][-1]
-                means[player] = gauss.mu
+        self.mus += (DEFAULT_MU - self.mus) * DECAY_RATE
+        self.sigmas += (DEFAULT_SIGMA - self.sigmas) * DECAY_RATE
+
+    def _sync(self):
+        """Update the arrays of the players the model changed since the last time"""
+        if self.model is None and (self._posteriors is not None or not self.matches):
+            return  # the arrays were filled as players were interned
+        model = self._update_model()
+        if self._synced is model:
+            changed = [player for player in model.changed if player in self.ids]
+        else:
+            changed = self.names
+            self._synced = model
+        for player in changed:
+            self.mus[self.ids[player]], self.sigmas[self.ids[player]] = self._posterior(
+                player
+            )
+        model.changed.clear()
+
+    def total_variance(self):
+        """Sum of the posterior variances of all players"""
+        self._sync()
+        return float(np.dot(self.sigmas, self.sigmas))
+
+    def win_probabilities(self, players=None):
+        """
+        Matrix of the chances of each of players (all of them by default)
+        beating each other, as in a TrueSkill game.
+        """
+        self._sync()
+        ids = slice(None) if players is None else [self.ids[p] for p in players]
+        mus, sigmas = self.mus[ids], self.sigmas[ids]
+        variances = 2 * BETA * BETA + sigmas[:, None] ** 2 + sigmas[None, :] ** 2
+        t = (mus[:, None] - mus[None, :]) / np.sqrt(variances)
+        return _erfcc(-t / sqrt(2)) / 2
+
+    def get_ranked_players(self, players=None):
+        """players (all by default), by decreasing mean"""
+        self._sync()
+        return [self.names[index] for index in self._order(self._ids(players))]
+
+    def _ids(self, players=None):
+        """Ids of players, of all players by default, in id order"""
+        if players is None:
+            return np.arange(len(self.names))
+        return np.unique(np.fromiter((self.ids[p] for p in players), dtype=np.intp))
+
+    def _order(self, ids=None):
+        """ids (all by default) by decreasing mean, the first of equals first"""
+        if ids is None:
+            return np.argsort(-self.mus, kind="stable")
+        return ids[np.argsort(-self.mus[ids], kind="stable")]
+
+    def _contenders(self, top, ids=None):
+        """
+        Mask of the first top + 1 of ids (all by default) in the ranking, and
+        of those of ids within CONTENDING deviations of the last of them.
+        """
+        order = self._order(ids)
+        contending = np.zeros(len(self.names), dtype=bool)
+        contending[order[: top + 1]] = True
+        if top < len(order):
+            last = order[top]
+            deviations = np.sqrt(self.sigmas[order] ** 2 + self.sigmas[last] ** 2)
+            contending[order] |= (
+                self.mus[order] + CONTENDING * deviations >= self.mus[last]
+            )
+        return contending
+
+    def ranking_confidence(self, top=None, players=None):
+        """
+        Chance that a player is better than the next one in the ranking, for
+        the least certain of the first top of players (of all by default).
+        """
+        self._sync()
+        order = self._order(self._ids(players))[: None if top is None else top + 1]
+        if len(order) < 2:
+            return 1.0
+        mus, sigmas = self.mus[order], self.sigmas[order]
+        t = (mus[:-1] - mus[1:]) / np.sqrt(sigmas[:-1] ** 2 + sigmas[1:] ** 2)
+        return float(np.min(_erfcc(-t / sqrt(2)) / 2))
+
+    def _update_model(self):
+        if self.model is None and self._saved:
+            # millions of small objects: collecting while they are created
+            # takes several times as long as creating them
+            collecting = gc.isenabled()
+            gc.disable()
+            try:
+                with open(_model_path(self.path), "rb") as file:
+                    model = _ModelUnpickler(file).load()
+            except FileNotFoundError:
+                self._saved = 0
             else:
-                means[player] = DEFAULT_MU
-
-        # update self.skill so recommend_pair can use the current μ values
-        for player, mu in means.items():
-            self.skill[player] = (mu, self.skill[player][1])
-        return means
-
-    def get_ranked_players(self):
-        means = self._build_model()
-        # Sort descending by mean
-        return [player for player in sorted(means, key=lambda x: -means[x])]
-
-    def recommend_pair(self) -> tuple[str, str]:
-        if not self.players:
-            raise RuntimeError("no players to compare")
-
-        # current total variance (sum of σ²)
-        prior_var = sum(sigma * sigma for _, sigma in self.skill.values())
-
-        best_pair = None
-        best_evoi = -1.0
-
-        # for each candidate match
-        for left, right in combinations(self.players, 2):
-            mu_left, sig_left = self.skill[left]
-            mu_right, sig_right = self.skill[right]
-            # approximate win probability under two independent Gaussians
-            denom = sqrt(sig_left * sig_left + sig_right * sig_right)
-            if denom == 0:
-                continue
-            p_left_wins = cdf(0.0, mu_right - mu_left, denom)  # P(left beats right)
-
-            # simulate left wins
-            comp_left = [[x] for x in [left, right]]
-            res_left = [[1, 0]]
-            hist_left = History(
-                [[[left], [right]] + comp for comp in []], [[1, 0]] + []
-            )  # reuse existing matches below
-            # actually we need full history, so:
-            composition = [[[w], [l]] for (w, l) in self.matches] + [[[left], [right]]]
-            results = [[1, 0] for _ in self.matches] + [[1, 0]]
-            hist_left = History(composition, results)
-            hist_left.convergence()  # propagate information
-
-            # simulate right wins
-            composition_right = [[[w], [l]] for (w, l) in self.matches] + [
-                [[right], [left]]
+                if len(model) <= len(self.matches):
+                    self.model = model
+            finally:
+                if collecting:
+                    gc.enable()
+        if self.model is None:
+            self.model = IncrementalHistory(
+                [[[winner], [loser]] for winner, loser in self.matches],
+                [[1, 0]] * len(self.matches),
+            )
+        for winner, loser in self.matches[len(self.model) :]:
+            self.model.add_game([[winner], [loser]], [1, 0])
+        return self.model
+
+    def _gaussians(self, ids=None):
+        """player -> (mu, sigma) of ids (all by default), by name"""
+        self._sync()
+        ids = self._ids() if ids is None else ids
+        return {
+            self.names[index]: (float(self.mus[index]), float(self.sigmas[index]))
+            for index in sorted(ids.tolist(), key=self.names.__getitem__)
+        }
+
+    def _exact_evois(self, pairs, gaussians, workers=None):
+        """
+        Expected reduction of the total variance of the league by a game of
+        each of pairs, simulating both results. With workers, pairs are
+        simulated in a pool of that many processes, each sent the matches
+        once; the results are the same as without.
+        """
+        players = sorted(self.players)
+        if workers is None:
+            variances = [
+                simulated_variances(self.matches, players, left, right)
+                for left, right in pairs
             ]
-            results_right = [[1, 0] for _ in self.matches] + [[1, 0]]
-            hist_right = History(composition_right, results_right)
-            hist_right.convergence()
-
-            # compute total posterior variance for each scenario
-            var_left = 0.0
-            var_right = 0.0
-            curves_left = hist_left.learning_curves()
-            curves_right = hist_right.learning_curves()
-            for player in self.players:
-                # get last sigma
-                sigma_left = curves_left.get(
-                    player, [(None, type("G", (), {"sigma": DEFAULT_SIGMA}))]
-                )[-1][1].sigma
-                sigma_right = curves_right.get(
-                    player, [(None, type("G", (), {"sigma": DEFAULT_SIGMA}))]
-                )[-1][1].sigma
-                var_left += sigma_left * sigma_left
-                var_right += sigma_right * sigma_right
-
-            # expected posterior variance
-            exp_post_var = p_left_wins * var_left + (1 - p_left_wins) * var_right
-            evoi = prior_var - exp_post_var
-
-            if evoi > best_evoi:
-                best_evoi = evoi
-                best_pair = (left, right)
-
-        if best_pair is None:
+        else:
+            from concurrent.futures import ProcessPoolExecutor
+
+            with ProcessPoolExecutor(
+                workers,
+                initializer=_set_worker_league,
+                initargs=(self.matches, players),
+            ) as pool:
+                chunksize = max(1, len(pairs) // (4 * workers))
+                variances = list(
+                    pool.map(_worker_variances, pairs, chunksize=chunksize)
+                )
+        prior = self.total_variance()
+        evois = []
+        for (left, right), (left_wins, right_wins) in zip(pairs, variances):
+            (mu_left, sigma_left), (mu_right, sigma_right) = (
+                gaussians[left],
+                gaussians[right],
+            )
+            p_left_wins = cdf(
+                0.0,
+                mu_right - mu_left,
+                sqrt(sigma_left**2 + sigma_right**2 + 2 * BETA**2),
+            )
+            evois.append(
+                prior - (p_left_wins * left_wins + (1 - p_left_wins) * right_wins)
+            )
+        return evois
+
+    def recommend_pair(
+        self, refine=0, workers=None, band=None, neighbours=None
+    ) -> tuple[str, str]:
+        """
+        Pair with the highest expected value of information, approximated by
+        the variance one TrueSkill update of the two players would remove.
+        With band or neighbours, only the candidate_pairs are scored, and
+        on_prune is told how many were left out.
+        With refine, the best refine pairs are scored again converging the
+        whole history with each result, which is slow but exact, in a pool
+        of workers processes if given.
+        """
+        return self.recommend_pairs(1, refine, workers, band, neighbours)[0]
+
+    def recommend_pairs(
+        self,
+        k=1,
+        refine=0,
+        workers=None,
+        band=None,
+        neighbours=None,
+        threshold=0,
+        top=None,
+        players=None,
+    ) -> list[tuple[str, str]]:
+        """
+        Up to k pairs of players (all by default), no player in more than
+        one, so they can be compared at once, by decreasing EVOI as in
+        recommend_pair, which is the first. With refine, at least k pairs are
+        refined. Only pairs with an EVOI above threshold are recommended and,
+        with top, only pairs of players that could still be in the first
+        top + 1 of their ranking.
+        """
+        ids = self._ids(players)
+        if len(ids) < 2:
+            raise RuntimeError("no players to compare")
+        self._sync()
+        by_name = np.array(sorted(ids.tolist(), key=self.names.__getitem__))
+        total = len(by_name) * (len(by_name) - 1) // 2
+        if band is None and neighbours is None:
+            left, right = np.triu_indices(len(by_name), 1)
+            left, right = by_name[left], by_name[right]
+        else:
+            pairs = candidate_pairs(self._gaussians(ids), band, neighbours)
+            left, right = (
+                np.array(
+                    [(self.ids[left], self.ids[right]) for left, right in pairs],
+                    dtype=np.intp,
+                )
+                .reshape(-1, 2)
+                .T
+            )
+        if top is not None:
+            contending = self._contenders(top, ids)
+            kept = contending[left] & contending[right]
+            left, right = left[kept], right[kept]
+        if self.on_prune is not None:
+            self.on_prune(total - len(left), total)
+        if not len(left):
+            raise RuntimeError("no pair within the uncertainty band")
+        scores = approximate_evoi_array(
+            self.mus[left], self.sigmas[left], self.mus[right], self.sigmas[right]
+        )
+        if refine:
+            best = _best_first(scores, max(refine, k))
+            left, right = left[best], right[best]
+            pairs = [(self.names[l], self.names[r]) for l, r in zip(left, right)]
+            scores = np.array(self._exact_evois(pairs, self._gaussians(), workers))
+        candidates = min(len(scores), 4 * k)
+        while True:
+            chosen, used, exhausted = [], set(), True
+            for index in _best_first(scores, candidates):
+                if scores[index] <= threshold:
+                    break
+                pair = (self.names[left[index]], self.names[right[index]])
+                if used.isdisjoint(pair):
+                    used.update(pair)
+                    chosen.append(pair)
+                    if len(chosen) == k:
+                        break
+            else:
+                exhausted = candidates == len(scores)
+            if len(chosen) == k or exhausted or scores[index] <= threshold:
+                break
+            candidates = min(len(scores), 4 * candidates)
+        if not chosen:
             raise RuntimeError("league perfectly sorted or no informative comparison")
-
-        return best_pair
+        return chosen
 
 
 # In-memory leagues for testing and scripting
 LEAGUE_CACHE = {}
 
 
-def sorted_tstt(players, league_name=None, top=None, limit=None, key=None, minimum=0):
+def sorted_tstt(
+    players,
+    league_name=None,
+    top=None,
+    limit=None,
+    key=None,
+    minimum=0,
+    batch_size=1,
+    key_workers=None,
+    confidence=None,
+    threshold=0,
+    refine=0,
+    workers=None,
+    band=None,
+    neighbours=None,
+):
     """
     Sort players by TrueSkill Through time.
 
@@ -182,43 +811,90 @@ def sorted_tstt(players, league_name=None, top=None, limit=None, key=None, minim
     players : list of str
         List of players to sort.
     league_name : str, optional
-        Name of the league to use. If not found, a new league is created. If None, the league is not saved.
+        Name of the league to use, in LEAGUES_FOLDER. If not found, a new league is created. If None, the league is not saved.
     top : int, optional
-        Number of players to consider for the recommendation. If None, all players are considered.
+        Number of leading players to sort: only players that could still be among them are compared, and confidence is only required of them. If None, all players are sorted.
     limit : int, optional
-        Maximum number of iterations to run. If None, the limit is set to N*log(N)
+        Maximum number of comparisons between players, counting those already in the league. If None, the limit is set to N*log(N)
     key : callable, optional
         Function to use to sort the players.
     minimum : int, optional
-        Minimum number of iterations to run. If None, the minimum is set to 0.
+        Minimum number of iterations to run, before confidence and threshold are considered. If None, the minimum is set to 0.
+    batch_size : int, optional
+        Number of disjoint pairs recommended at once. Their keys are computed concurrently, by up to key_workers threads, and all their results added before the model is updated.
+    key_workers : int, optional
+        Threads computing keys in batches. If None, the ThreadPoolExecutor default.
+    confidence : float, optional
+        Stop once every player (of the top ones) is better than the next one in the ranking with at least this chance.
+    threshold : float, optional
+        Stop once no comparison is expected to reduce the total variance by more than this.
+    refine, workers, band, neighbours : optional
+        How pairs are recommended, as in TSTTLeague.recommend_pair: workers are processes simulating the refined pairs.
     """
     if len(players) < 2:
         return players
-    players = set(players)
+    players = list(dict.fromkeys(players))  # in a fixed order, unlike a set
     if limit is None:
         limit = ceil(len(players) * log(len(players)))
-    limit = max(limit, minimum)
 
     if league_name is None:
         league = TSTTLeague()
     else:
         league = LEAGUE_CACHE.get(league_name)
         if league is None:
-            league = TSTTLeague()
+            league = TSTTLeague.load(league_name, create=True)
             LEAGUE_CACHE[league_name] = league
 
     league.add_players(players)
+    # so a backlog sorted before is only asked about what is new
+    given = set(players)
+    known = sum(winner in given and loser in given for winner, loser in league.matches)
+    limit = max(limit - known, minimum)
 
-    for _ in range(limit):
-        try:
-            left, right = league.recommend_pair()
-        except Exception:
-            break
-        key_left = key(left) if key else left
-        key_right = key(right) if key else right
-        if key_left < key_right:
-            league.add_result(right, left)
-        else:
-            league.add_result(left, right)
+    if batch_size > 1 and key is not None:
+        from concurrent.futures import ThreadPoolExecutor
 
-    return league.get_ranked_players()
+        pool = ThreadPoolExecutor(key_workers)
+    else:
+        pool = nullcontext()
+    with pool:
+        step = 0
+        while step < limit:
+            settled = step >= minimum
+            if (
+                settled
+                and confidence is not None
+                and league.ranking_confidence(top, players) >= confidence
+            ):
+                break
+            try:
+                pairs = league.recommend_pairs(
+                    min(batch_size, limit - step),
+                    refine,
+                    workers,
+                    band,
+                    neighbours,
+                    threshold=threshold if settled else 0,
+                    top=top,
+                    players=players,
+                )
+            except RuntimeError:
+                break
+            compared = [player for pair in pairs for player in pair]
+            if key is None:
+                keys = compared
+            elif batch_size > 1:
+                keys = pool.map(key, compared)
+            else:
+                keys = map(key, compared)
+            keys = dict(zip(compared, keys))
+            for left, right in pairs:
+                if keys[left] < keys[right]:
+                    league.add_result(right, left)
+                else:
+                    league.add_result(left, right)
+            step += len(pairs)
+
+    if league.path is not None:
+        league.save()
+    return league.get_ranked_players(players)
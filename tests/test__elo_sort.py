@@ -1,7 +1,17 @@
-from pytest import approx
+from itertools import combinations
+from math import ceil, log
+from statistics import NormalDist
+import pickle
+import os
+import random
+import subprocess
+import sys
+import types
 
-from src import elo_sort
+from pytest import approx, raises
+import numpy as np
 
+from src import elo_sort
 
 """
 >>> from statistics import NormalDist
@@ -105,3 +115,462 @@ def _test__recommends_matches():
         assert recommended_match is not None
         white, black = recommended_match
         league.add_result(white, ">", black)
+
+
+def _random_league(size, results, seed=0):
+    rng = random.Random(seed)
+    league = elo_sort.League()
+    players = [f"player {index}" for index in range(size)]
+    league.add_players(players)
+    for _ in range(results):
+        white, black = rng.sample(players, 2)
+        league.add_result(white, rng.choice("<=>"), black)
+    return league, players
+
+
+def test__match_engine_overlap_matches_normal_dist():
+    league, players = _random_league(40, 120)
+    engine = elo_sort.MatchEngine(league)
+    left, right = zip(*combinations(range(len(players)), 2))
+    overlaps = engine.overlap(np.array(left), np.array(right))
+    for overlap, l, r in zip(overlaps, left, right):
+        expected = league._get_norm_dist(players[l]).overlap(
+            league._get_norm_dist(players[r])
+        )
+        assert overlap == approx(expected, abs=1e-12)
+
+
+def test__match_engine_best_match_matches_brute_force():
+    for seed in range(20):
+        league, players = _random_league(30, 60, seed=seed)
+        engine = elo_sort.MatchEngine(league)
+        ids = np.arange(len(players))
+        for threshold in (0, elo_sort.OVERLAP_THRESHOLD, 0.5):
+            top_overlap = 0
+            top_match = None
+            for lenght in range(2, 4):
+                for f in range(len(players) - lenght + 1):
+                    for left, right in combinations(players[f : f + lenght], 2):
+                        overlap = league.overlap(left, right)
+                        if overlap > top_overlap:
+                            top_overlap = overlap
+                            top_match = (left, right)
+                if top_overlap > threshold:
+                    break
+            match, overlap = engine.best_match(ids, threshold)
+            assert tuple(players[index] for index in match) == top_match
+            assert overlap == approx(top_overlap, abs=1e-12)
+
+            neighbours = {
+                other
+                for player in players[:5]
+                for other in players
+                if other != player and league.overlap(player, other) > threshold
+            }
+            selected = engine.neighbours(ids[:5], ids, threshold)
+            assert len(selected) == len(neighbours)
+            assert {players[index] for index in selected} == neighbours
+
+
+class _LegacyLeague:
+    """League as pickled before the array storage"""
+
+
+def test__load_migrates_legacy_pickles(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    legacy = types.ModuleType("legacy_elo_sort")
+    _LegacyLeague.__module__ = legacy.__name__
+    _LegacyLeague.__qualname__ = "League"
+    legacy.League = _LegacyLeague
+    monkeypatch.setitem(sys.modules, legacy.__name__, legacy)
+
+    old = _LegacyLeague()
+    old.elos = {"Adrian": 1700.0, "Beatriz": 1300.0}
+    old.games = {"Adrian": 1, "Beatriz": 1}
+    old.perfect_score_players = {"Adrian"}
+    old.path = tmp_path / "legacy"
+    with open(old.path, "wb") as file:
+        pickle.dump(old, file)
+
+    league = elo_sort.League.load("legacy")
+    assert league.get_ranking() == [(1700.0, "Adrian"), (1300.0, "Beatriz")]
+    assert league.games["Beatriz"] == 1
+    assert league.perfect_score_players == {"Adrian"}
+
+    league.add_result("Adrian", ">", "Beatriz")
+    league.save()
+    league = elo_sort.League.load("legacy")
+    assert league.games["Adrian"] == 2
+    assert league.elos["Adrian"] > 1700
+
+
+def test__journal_replays_results_after_crash(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    league = elo_sort.League.load("journaled", create=True)
+    league.add_players(["Adrian", "Beatriz", "Carlos"])
+    league.add_result("Adrian", ">", "Beatriz")
+    league.add_result("Carlos", "=", "Adrian")
+    # no save, no close: the process died here
+
+    replayed = elo_sort.League.load("journaled")
+    assert replayed.get_ranking() == league.get_ranking()
+    assert replayed.games == league.games
+    assert replayed.perfect_score_players == league.perfect_score_players
+
+
+def test__journal_ignores_torn_last_entry(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    league = elo_sort.League.load("torn", create=True)
+    league.add_players(["Adrian", "Beatriz"])
+    league.add_result("Adrian", ">", "Beatriz")
+    league.close()
+    with open(tmp_path / "torn.journal", "a") as file:
+        file.write('["Beatriz", ">", "Adr')
+
+    journal = (tmp_path / "torn.journal").read_bytes()
+    league = elo_sort.League.load("torn")
+    assert league.games["Adrian"] == 1
+    # only a writer, under the journal lock, cuts the torn line off
+    assert (tmp_path / "torn.journal").read_bytes() == journal
+    league.add_result("Beatriz", ">", "Adrian")
+    league.close()
+    assert elo_sort.League.load("torn").get_ranking() == league.get_ranking()
+
+
+def test__compaction_starts_a_new_journal(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    monkeypatch.setattr(elo_sort, "COMPACT_EVERY", 4)
+    with elo_sort.League.load("compacted", create=True) as league:
+        league.add_players(["Adrian", "Beatriz"])
+        league.add_result("Adrian", ">", "Beatriz")
+    journal = tmp_path / "compacted.journal"
+    assert len(journal.read_text().splitlines()) == 4
+    assert not (tmp_path / "compacted").exists()
+
+    with elo_sort.League.load("compacted") as league:
+        league.add_result("Adrian", ">", "Beatriz")
+    assert league.epoch == 1
+    assert journal.read_text().splitlines() == ['{"epoch": 1}']
+
+    with elo_sort.League.load("compacted") as loaded:
+        assert loaded.get_ranking() == league.get_ranking()
+        loaded.add_result("Beatriz", ">", "Adrian")
+    assert len(journal.read_text().splitlines()) == 2
+
+    # the snapshot was written, but the journal was not reset
+    journal.write_text('{"epoch": 0}\n["Adrian", ">", "Beatriz"]\n')
+    assert elo_sort.League.load("compacted").get_ranking() == league.get_ranking()
+
+
+def test__results_journaled_by_another_process_are_not_lost(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    with elo_sort.League.load("shared", create=True) as league:
+        league.add_players(["Adrian", "Beatriz"])
+    first = elo_sort.League.load("shared")
+    second = elo_sort.League.load("shared")
+    first.add_result("Adrian", ">", "Beatriz")
+    with raises(RuntimeError):
+        second.add_result("Beatriz", ">", "Adrian")
+    with raises(RuntimeError):
+        second.compact()
+    second = elo_sort.League.load("shared")
+    second.add_result("Beatriz", ">", "Adrian")
+    assert second.games["Adrian"] == 2
+
+    # a compaction by another process also makes this league reload
+    second.compact()
+    with raises(RuntimeError):
+        first.add_result("Adrian", ">", "Beatriz")
+    first.close()
+    assert elo_sort.League.load("shared").get_ranking() == second.get_ranking()
+
+
+def test__recommended_matches_are_disjoint_and_start_with_the_best():
+    for seed in range(20):
+        league, players = _random_league(30, 45, seed=seed)
+        for top in (None, 5):
+            for threshold in (0, elo_sort.OVERLAP_THRESHOLD, 0.5):
+                try:
+                    best = league.recommended_match(top=top, threshold=threshold)
+                except RuntimeError:
+                    continue
+                matches = league.recommended_matches(top=top, threshold=threshold, k=5)
+                assert matches[0] == best
+                assert 1 <= len(matches) <= 5
+                matched = [player for match, _ in matches for player in match]
+                assert len(matched) == len(set(matched))
+
+
+def test__elo_sorted_in_batches(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    players = [f"{number:02}" for number in range(20)]
+    random.Random(0).shuffle(players)
+    calls = []
+
+    def key(player):
+        calls.append(player)
+        return player
+
+    ranking = elo_sort.elo_sorted(players, "batches", key=key, batch_size=4)
+    assert 0 < len(calls) <= 2 * ceil(20 * log(20))
+    assert sorted(ranking) == sorted(players)
+    assert "00" in ranking[:5]
+
+
+def test__elo_sorted_computes_each_key_once(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    players = [f"{number:02}" for number in range(20)]
+    calls = []
+
+    def key(player):
+        calls.append(player)
+        return player
+
+    ranking = elo_sort.elo_sorted(players, "serial", key=key)
+    assert len(calls) == len(set(calls))
+
+    calls.clear()
+    threaded = elo_sort.elo_sorted(
+        players, "threads", key=key, executor="thread", workers=4
+    )
+    assert sorted(calls) == players
+    assert threaded == ranking
+
+    processes = elo_sort.elo_sorted(players, "processes", key=str, executor="process")
+    assert processes == ranking
+
+
+def test__ranking_index_follows_results():
+    league, players = _random_league(50, 0)
+    rng = random.Random(1)
+    assert [player for _, player in league.top(3)] == players[:3]
+    for step in range(500):
+        white, black = rng.sample(players, 2)
+        league.add_result(white, rng.choice("<=>"), black)
+        if step % 50 == 0:
+            league.add_players([f"newcomer {step}"])
+            players.append(f"newcomer {step}")
+
+    ids = np.arange(league.size)
+    expected = ids[np.argsort(-league._elos[ids], kind="stable")]
+    assert [player for _, player in league.get_ranking()] == [
+        league.names[index] for index in expected
+    ]
+    for rank, (elo, player) in enumerate(league.get_ranking(), start=1):
+        assert league.rank_of(player) == rank
+    assert league.top(5) == league.get_ranking()[:5]
+    subset = players[::3]
+    assert (
+        league.top(4, subset)
+        == [rank for rank in league.get_ranking() if rank[1] in subset][:4]
+    )
+
+
+def test__pruned_neighbours_match_brute_force():
+    for seed in range(5):
+        league, players = _random_league(150, 600, seed=seed)
+        engine = elo_sort.MatchEngine(league)
+        ids = np.arange(league.size)
+        ranking = league._ranked(ids)
+        for top in (1, 10, 150):
+            for threshold in (1e-6, elo_sort.OVERLAP_THRESHOLD, 0.2, 0.9):
+                pruned = engine.neighbours(ranking[:top], ids, threshold)
+                brute = engine.neighbours(ranking[:top], ids, threshold, prune=False)
+                assert pruned.tolist() == brute.tolist()
+
+
+def test__overlap_kernels_match_normal_dist():
+    rng = np.random.default_rng(0)
+    size = 5000
+    mu_x = rng.uniform(1000, 2000, size)
+    mu_y = mu_x + rng.normal(0, 400, size)
+    sigma_x = rng.uniform(1, 400, size)
+    sigma_y = np.where(np.arange(size) % 3, rng.uniform(1, 400, size), sigma_x)
+    expected = [
+        NormalDist(*x).overlap(NormalDist(*y))
+        for x, y in zip(zip(mu_x, sigma_x), zip(mu_y, sigma_y))
+    ]
+    assert elo_sort.overlap_array(mu_x, sigma_x, mu_y, sigma_y) == approx(
+        expected, abs=1e-12
+    )
+    assert elo_sort.overlap_array(mu_x, sigma_x, mu_y, sigma_x) == approx(
+        [
+            NormalDist(x, s).overlap(NormalDist(y, s))
+            for x, s, y in zip(mu_x, sigma_x, mu_y)
+        ],
+        abs=1e-12,
+    )
+    for x, s_x, y, s_y, overlap in zip(mu_x, sigma_x, mu_y, sigma_y, expected):
+        assert elo_sort.overlap(x, s_x, y, s_y) == approx(overlap, abs=1e-12)
+        assert elo_sort.overlap(y, s_y, x, s_x) == approx(overlap, abs=1e-12)
+
+
+def test__import_is_light_and_side_effect_free(tmp_path):
+    code = (
+        "import sys; from src import elo_sort;"
+        "print(*(m for m in ('click', 'statistics', 'concurrent.futures')"
+        " if m in sys.modules))"
+    )
+    loaded = subprocess.run(
+        [sys.executable, "-c", code],
+        env={**os.environ, "HOME": str(tmp_path)},
+        check=True,
+        capture_output=True,
+        text=True,
+    ).stdout.split()
+    assert loaded == []
+    assert list(tmp_path.iterdir()) == []
+
+
+def test__glicko2_matches_glickman_example():
+    league = elo_sort.League("glicko2")
+    league.add_players(["Adrian", "Beatriz", "Carlos", "Diana"])
+    for player, rating, deviation in [
+        ("Adrian", 1500, 200),
+        ("Beatriz", 1400, 30),
+        ("Carlos", 1550, 100),
+        ("Diana", 1700, 300),
+    ]:
+        league._elos[league.index[player]] = rating
+        league.backend.deviations[league.index[player]] = deviation
+    league.add_result("Adrian", ">", "Beatriz")
+    league.add_result("Carlos", ">", "Adrian")
+    league.add_result("Adrian", "<", "Diana")
+    assert league.elos["Adrian"] == 1500  # until the period ends
+    league.end_period()
+    assert league.elos["Adrian"] == approx(1464.06, abs=0.01)
+    adrian = league.index["Adrian"]
+    assert league.backend.deviations[adrian] == approx(151.52, abs=0.01)
+    assert league.backend.volatilities[adrian] == approx(0.05999, abs=1e-5)
+
+
+def test__glicko2_league_replays_rating_periods(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    league = elo_sort.League.load("glicko", create=True, backend="glicko2")
+    league.add_players(["Adrian", "Beatriz", "Carlos"])
+    league.add_result("Adrian", ">", "Beatriz")
+    league.add_result("Carlos", ">", "Beatriz")
+    league.end_period()
+    league.add_result("Carlos", "=", "Adrian")
+    league.end_period()
+    league.add_result("Beatriz", ">", "Adrian")  # still pending
+    journal = (tmp_path / "glicko.journal").read_bytes()
+    ranking = league.get_ranking()
+    league.recommended_matches()
+    assert league.elos == {player: elo for elo, player in ranking}
+    assert league.backend.pending
+    assert (tmp_path / "glicko.journal").read_bytes() == journal
+
+    replayed = elo_sort.League.load("glicko")
+    assert replayed.backend.name == "glicko2"
+    assert replayed.get_ranking() == league.get_ranking()
+    assert replayed.backend.deviations.tolist() == league.backend.deviations.tolist()
+
+    league.compact()
+    compacted = elo_sort.League.load("glicko")
+    assert compacted.get_ranking() == league.get_ranking()
+
+
+def test__single_neglected_player_gets_a_match():
+    league = elo_sort.League()
+    league.add_players(["Adrian", "Beatriz", "Carlos", "Diana"])
+    for _ in range(3):
+        league.add_result("Adrian", ">", "Beatriz")
+        league.add_result("Beatriz", ">", "Carlos")
+    league.add_result("Carlos", ">", "Diana")
+    (match, _), *_ = league.recommended_matches()
+    assert "Diana" in match
+
+
+def test__elo_sorted_with_glicko2(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    players = [f"{index:02}" for index in range(30)]
+    random.Random(0).shuffle(players)
+    ranking = elo_sort.elo_sorted(
+        players, "sorted", key=int, batch_size=4, backend="glicko2"
+    )
+    assert sorted(ranking) == sorted(players)
+    concordant = sum(int(a) < int(b) for a, b in combinations(ranking, 2))
+    assert concordant > 0.8 * len(list(combinations(ranking, 2)))
+    assert elo_sort.League.load("sorted").backend.name == "glicko2"
+
+
+def test__columns_answer_like_the_league(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    league, _ = _random_league(200, 600, seed=3)
+    league.add_players(["Ñandú", "Zoë"])
+    league.add_result("Ñandú", ">", "Zoë")
+    league.save("columns")
+
+    columns = elo_sort.open_ranking("columns")
+    assert isinstance(columns, elo_sort.LeagueColumns)
+    assert len(columns) == league.size
+    assert columns.get_ranking() == league.get_ranking()
+    assert columns.top(20) == league.top(20)
+    subset = random.Random(0).sample(league.names, 30)
+    assert columns.top(5, subset) == league.top(5, subset)
+    for player in league.names:
+        assert columns.rank_of(player) == league.rank_of(player)
+        assert columns.games_of(player) == league.games[player]
+    with raises(KeyError):
+        columns.rank_of("nobody")
+    with columns:
+        pass
+    assert columns._map.closed
+
+
+def test__columns_are_not_used_once_stale(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    league, _ = _random_league(20, 40, seed=4)
+    league.save("stale")
+    league = elo_sort.League.load("stale")
+    league.add_result(league.names[-1], ">", league.names[0])
+    ranking = elo_sort.open_ranking("stale")
+    assert isinstance(ranking, elo_sort.League)
+    assert ranking.get_ranking() == league.get_ranking()
+
+    # saving brings the columns up to the journal again
+    league.save()
+    columns = elo_sort.open_ranking("stale")
+    assert isinstance(columns, elo_sort.LeagueColumns)
+    assert columns.get_ranking() == league.get_ranking()
+    columns.close()
+
+    glicko = elo_sort.League("glicko2")
+    glicko.add_players(["Adrian", "Beatriz"])
+    glicko.add_result("Adrian", ">", "Beatriz")
+    glicko.save("pending")
+    assert not (tmp_path / "pending.columns").exists()
+    assert isinstance(elo_sort.open_ranking("pending"), elo_sort.League)
+
+
+def test__interrupted_save_leaves_a_consistent_league(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    with elo_sort.League.load("saved", create=True) as old:
+        old.add_players(["Adrian", "Beatriz"])
+        old.add_result("Adrian", ">", "Beatriz")
+    new = elo_sort.League()
+    new.add_players(["Carmen", "Daniel"])
+    new.add_result("Daniel", ">", "Carmen")
+
+    def crash(*arguments):
+        raise OSError("crash")
+
+    # after the columns, before the snapshot
+    with monkeypatch.context() as patch:
+        patch.setattr(elo_sort.pickle, "dump", crash)
+        with raises(OSError):
+            new.save("saved")
+    assert elo_sort.open_ranking("saved").get_ranking() == old.get_ranking()
+
+    # after the snapshot, before the journal
+    with monkeypatch.context() as patch:
+        patch.setattr(elo_sort.League, "_write_journal", crash)
+        with raises(OSError):
+            new.save("saved")
+    ranking = elo_sort.open_ranking("saved")
+    assert isinstance(ranking, elo_sort.League)
+    assert ranking.get_ranking() == new.get_ranking()
+
+    new.save("saved")
+    assert elo_sort.open_ranking("saved").get_ranking() == new.get_ranking()
@@ -0,0 +1,73 @@
+import os
+import threading
+
+from src import elo_sort, elo_sortd
+
+
+def test__server_keeps_leagues_in_memory(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    path = str(tmp_path / "elo_sortd.sock")
+    server = elo_sortd.make_server(path)
+    assert os.stat(path).st_mode & 0o777 == 0o600
+    thread = threading.Thread(target=server.serve_forever)
+    thread.start()
+    try:
+        with elo_sortd.Client(path) as client:
+            client.request("add_players", league="tasks", players=["a", "b", "c"])
+            client.request(
+                "add_result", league="tasks", white="a", relation=">", black="b"
+            )
+            client.request(
+                "add_result", league="tasks", white="c", relation=">", black="a"
+            )
+            ranking = client.request("ranking", league="tasks")
+            assert [player for _, player in ranking] == ["c", "a", "b"]
+            assert client.request("ranking", league="tasks", n=1)[0][1] == "c"
+            assert client.request("rank_of", league="tasks", player="b") == 3
+            matches = client.request("recommend", league="tasks", k=2)
+            assert len(matches) == 1
+            try:
+                client.request("shuffle", league="tasks")
+            except RuntimeError as error:
+                assert "unknown command" in str(error)
+            else:
+                assert False
+    finally:
+        server.shutdown()
+        server.server_close()
+        thread.join()
+
+    league = elo_sort.League.load("tasks")
+    assert [player for _, player in league.get_ranking()] == ["c", "a", "b"]
+
+
+def test__request_without_server(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    monkeypatch.setattr(elo_sortd, "SOCKET_PATH", str(tmp_path / "none.sock"))
+    handled = []
+
+    class Leagues(elo_sortd.Leagues):
+        def handle(self, command, league, **arguments):
+            handled.append(command)
+            return super().handle(command, league, **arguments)
+
+    monkeypatch.setattr(elo_sortd, "Leagues", Leagues)
+    elo_sortd.request("add_result", league="tasks", white="a", relation="<", black="b")
+    assert elo_sortd.request("ranking", league="tasks", n=1) == [[1700.0, "b"]]
+    assert handled == ["add_result", "ranking"]
+    assert elo_sort.League.load("tasks").games["a"] == 1
+
+
+def test__read_only_requests_use_the_snapshot_columns(tmp_path, monkeypatch):
+    monkeypatch.setattr(elo_sort, "LEAGUES_FOLDER", str(tmp_path))
+    league = elo_sort.League()
+    league.add_players(["a", "b", "c"])
+    league.add_result("a", "<", "b")
+    league.save("tasks")
+
+    leagues = elo_sortd.Leagues()
+    assert leagues.handle("rank_of", league="tasks", player="b") == 1
+    assert leagues.handle("ranking", league="tasks", n=2) == league.top(2)
+    assert leagues.leagues == {}
+    leagues.handle("add_result", league="tasks", white="c", relation=">", black="b")
+    assert leagues.handle("rank_of", league="tasks", player="c") == 1
@@ -0,0 +1,143 @@
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import Process
+
+from pytest import mark, raises
+
+from src import primos
+
+
+def _ingenuos(hasta):
+    return [n for n in range(2, hasta + 1) if all(n % d for d in range(2, n))]
+
+
+@mark.parametrize("hasta", [0, 1, 2, 3, 10, 97, 1000])
+def test__primos_base(hasta):
+    assert primos.primos_base(hasta) == _ingenuos(hasta)
+
+
+def test__la_criba_segmentada_es_la_ingenua(tmp_path):
+    ruta = tmp_path / "criba"
+    assert primos.cribar(2000, ruta, segmento=64) == 2016
+    assert list(primos.primos(0, 2000, ruta)) == _ingenuos(2000)
+    assert list(primos.primos(0, 2, ruta)) == [2]
+    assert list(primos.primos(3, 3, ruta)) == [3]
+    assert list(primos.primos(1000, 1100, ruta, segmento=7)) == [
+        n for n in _ingenuos(1100) if n >= 1000
+    ]
+
+
+def test__la_criba_se_extiende_desde_donde_se_quedo(tmp_path):
+    entera, partida = tmp_path / "entera", tmp_path / "partida"
+    primos.cribar(5000, entera, segmento=100)
+    for hasta in (10, 11, 700, 300, 5000):
+        primos.cribar(hasta, partida, segmento=100)
+    assert partida.read_bytes() == entera.read_bytes()
+
+    # una escritura cortada a medias deja un prefijo válido
+    with open(partida, "r+b") as archivo:
+        archivo.truncate(157)
+    assert primos.cribar(5000, partida, segmento=100) == 5008
+    assert partida.read_bytes() == entera.read_bytes()
+
+
+def test__la_criba_en_paralelo_es_la_misma(tmp_path):
+    serie, paralelo = tmp_path / "serie", tmp_path / "paralelo"
+    primos.cribar(100000, serie, segmento=1000)
+    assert primos.cribar(30000, paralelo, segmento=1000, procesos=2) == 30016
+    assert primos.cribar(100000, paralelo, segmento=1000, procesos=3) == 100016
+    assert paralelo.read_bytes() == serie.read_bytes()
+    assert not (tmp_path / "paralelo.parcial").exists()
+
+
+def test__procesos_a_la_vez_no_cortan_la_criba(tmp_path):
+    serie, varios = tmp_path / "serie", tmp_path / "varios"
+    primos.cribar(200000, serie, segmento=160)
+    with ProcessPoolExecutor(4) as ejecutor:
+        futuros = [
+            ejecutor.submit(primos.cribar, 200000, varios, 160) for _ in range(4)
+        ]
+    assert {futuro.result() for futuro in futuros} == {200016}
+    assert varios.read_bytes() == serie.read_bytes()
+
+
+def test__cribas_en_paralelo_a_la_vez_comparten_el_bloqueo(tmp_path):
+    serie, paralelo = tmp_path / "serie", tmp_path / "paralelo"
+    primos.cribar(200000, serie, segmento=1600)
+    procesos = [
+        Process(target=primos.cribar, args=(200000, paralelo, 1600, 2))
+        for _ in range(2)
+    ]
+    for proceso in procesos:
+        proceso.start()
+    for proceso in procesos:
+        proceso.join()
+    assert paralelo.read_bytes() == serie.read_bytes()
+    assert not (tmp_path / "paralelo.parcial").exists()
+
+
+def test__los_negativos_no_son_primos(tmp_path):
+    ruta = tmp_path / "criba"
+    assert not primos.es_primo(-1, ruta)
+    assert list(primos.primos(0, -1, ruta)) == []
+    with primos.Tabla(ruta) as tabla:
+        assert tabla.cubre == 0
+        with raises(IndexError):
+            tabla.es_primo(2)
+
+
+def test__la_tabla_consulta_la_criba_sin_cargarla(tmp_path):
+    ruta = tmp_path / "criba"
+    primos.cribar(10**6, ruta)
+    assert ruta.stat().st_size == 10**6 // 16 + 1
+    cribados = set(_ingenuos(1000))
+    with primos.Tabla(ruta) as tabla:
+        assert [tabla.es_primo(n) for n in range(1000)] == [
+            n in cribados for n in range(1000)
+        ]
+        assert tabla.es_primo(999983) and not tabla.es_primo(999981)
+        assert list(tabla.primos(999900, 10**6, segmento=32)) == [
+            999907,
+            999917,
+            999931,
+            999953,
+            999959,
+            999961,
+            999979,
+            999983,
+        ]
+        with raises(IndexError):
+            tabla.es_primo(tabla.cubre)
+    assert primos.es_primo(1000003, ruta)
+
+
+def test__las_consultas_reutilizan_la_tabla(tmp_path, monkeypatch):
+    ruta = tmp_path / "criba"
+    primos.cribar(1000, ruta)
+    abiertas, cribadas = [], []
+    Tabla, cribar = primos.Tabla, primos.cribar
+
+    def abrir(*argumentos):
+        abiertas.append(argumentos)
+        return Tabla(*argumentos)
+
+    def extender(*argumentos):
+        cribadas.append(argumentos)
+        return cribar(*argumentos)
+
+    monkeypatch.setattr(primos, "Tabla", abrir)
+    monkeypatch.setattr(primos, "cribar", extender)
+    assert primos.es_primo(997, ruta)
+    assert not primos.es_primo(999, ruta)
+    assert list(primos.primos(990, 1000, ruta)) == [991, 997]
+    assert (len(abiertas), len(cribadas)) == (1, 0)
+    assert primos.es_primo(1009, ruta)
+    assert (len(abiertas), len(cribadas)) == (3, 1)
+    assert list(primos.primos(1000, 1010, ruta)) == [1009]
+    assert (len(abiertas), len(cribadas)) == (3, 1)
+
+
+def test__porcion():
+    lista = primos.primos_base(100)
+    assert primos.porcion(lista, 10, 30) == [11, 13, 17, 19, 23, 29]
+    assert primos.porcion(lista, 11, 29) == [11, 13, 17, 19, 23, 29]
+    assert primos.porcion(lista, 90, 96) == []
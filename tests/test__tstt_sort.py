@@ -0,0 +1,423 @@
+from itertools import combinations
+from math import ceil, erfc, inf, log, sqrt
+from random import Random
+
+import numpy as np
+from pytest import approx, raises
+from trueskillthroughtime import Game, Gaussian, History, Player, cdf
+
+from src import tstt_sort
+
+
+def _random_games(size, matches, seed=0):
+    rng = Random(seed)
+    players = [f"player {index:02}" for index in range(size)]
+    return [sorted(rng.sample(players, 2)) for _ in range(matches)], players
+
+
+def test__incremental_history_follows_full_convergence():
+    games, players = _random_games(12, 60)
+    incremental = tstt_sort.IncrementalHistory(
+        [[[winner], [loser]] for winner, loser in games[:20]], [[1, 0]] * 20
+    )
+    for winner, loser in games[20:]:
+        incremental.add_game([[winner], [loser]], [1, 0])
+    full = History([[[winner], [loser]] for winner, loser in games], [[1, 0]] * 60)
+    full.convergence(verbose=False)
+    curves = full.learning_curves()
+
+    assert len(incremental) == len(games)
+    for player in players:
+        assert incremental.posterior(player).mu == approx(
+            curves[player][-1][1].mu, abs=0.25
+        )
+        assert incremental.posterior(player).sigma == approx(
+            curves[player][-1][1].sigma, abs=0.1
+        )
+
+
+def test__learning_curves_are_invalidated_per_player():
+    history = tstt_sort.IncrementalHistory()
+    history.add_game([["a"], ["b"]], [1, 0])
+    history.add_game([["c"], ["d"]], [1, 0])
+    a, c = history.learning_curve("a"), history.learning_curve("c")
+    history.add_game([["b"], ["a"]], [1, 0])
+    assert history.learning_curve("c") is c
+    assert history.learning_curve("a") is not a
+    assert len(history.learning_curve("a")) == 2
+    assert history.posterior("e") is None
+
+
+def test__ranking_is_updated_incrementally():
+    league = tstt_sort.TSTTLeague()
+    league.add_players(["a", "b", "c"])
+    league.add_result("a", "b")
+    league.add_result("b", "c")
+    assert league.get_ranked_players() == ["a", "b", "c"]
+    model = league.model
+    league.add_result("c", "a")
+    league.add_result("c", "b")
+    league.add_result("c", "a")
+    assert league.get_ranked_players()[0] == "c"
+    assert league.model is model and len(model) == 5
+
+
+def test__approximate_evoi_is_one_trueskill_update():
+    for mu_left, sigma_left, mu_right, sigma_right in [
+        (0, 6, 0, 6),
+        (1, 2, 0, 3),
+        (3, 1, -2, 4),
+    ]:
+        variances = []
+        for result in ([1, 0], [0, 1]):
+            game = Game(
+                [
+                    [Player(Gaussian(mu_left, sigma_left))],
+                    [Player(Gaussian(mu_right, sigma_right))],
+                ],
+                result,
+            )
+            (left,), (right,) = game.posteriors()
+            variances.append(left.sigma**2 + right.sigma**2)
+        t = (mu_left - mu_right) / sqrt(2 + sigma_left**2 + sigma_right**2)
+        p_left_wins = erfc(-t / sqrt(2)) / 2
+        expected = sigma_left**2 + sigma_right**2
+        expected -= p_left_wins * variances[0] + (1 - p_left_wins) * variances[1]
+        assert tstt_sort.approximate_evoi(
+            mu_left, sigma_left, mu_right, sigma_right
+        ) == approx(expected, rel=1e-6)
+
+
+def test__recommend_pair_refines_the_best_approximations():
+    games, players = _random_games(6, 8, seed=1)
+    league = tstt_sort.TSTTLeague()
+    league.add_players(players)
+    for winner, loser in games:
+        league.add_result(winner, loser)
+    gaussians = league._gaussians()
+    approximate = {
+        pair: tstt_sort.approximate_evoi(*gaussians[pair[0]], *gaussians[pair[1]])
+        for pair in combinations(sorted(players), 2)
+    }
+    assert league.recommend_pair() == max(approximate, key=approximate.get)
+    best = sorted(approximate, key=approximate.get, reverse=True)[:3]
+    exact = dict(zip(best, league._exact_evois(best, gaussians)))
+    assert league.recommend_pair(refine=3) == max(exact, key=exact.get)
+
+    with raises(RuntimeError):
+        tstt_sort.TSTTLeague().recommend_pair()
+
+
+def test__exact_evois_in_a_process_pool_are_those_of_the_serial_path():
+    games, players = _random_games(8, 10, seed=2)
+    league = tstt_sort.TSTTLeague()
+    league.add_players(players)
+    for winner, loser in games:
+        league.add_result(winner, loser)
+    gaussians = league._gaussians()
+    pairs = list(combinations(sorted(players), 2))[:6]
+    serial = league._exact_evois(pairs, gaussians)
+    assert league._exact_evois(pairs, gaussians, workers=2) == serial
+    assert league.recommend_pair(refine=4, workers=2) == league.recommend_pair(refine=4)
+
+
+def test__candidate_pairs_are_those_of_a_brute_force_filter():
+    rng = Random(3)
+    gaussians = {
+        f"player {index:02}": (rng.gauss(25, 10), rng.uniform(0.5, 8))
+        for index in range(40)
+    }
+
+    def t(left, right):
+        (mu_left, sigma_left), (mu_right, sigma_right) = (
+            gaussians[left],
+            gaussians[right],
+        )
+        variance = 2 * tstt_sort.BETA**2 + sigma_left**2 + sigma_right**2
+        return abs(mu_left - mu_right) / sqrt(variance)
+
+    pairs = list(combinations(gaussians, 2))
+    band = [
+        (left, right)
+        for left, right in pairs
+        if erfc(t(left, right) / sqrt(2)) / 2 >= 0.2
+    ]
+    assert sorted(tstt_sort.candidate_pairs(gaussians, band=0.2)) == band
+    nearest = set()
+    for player in gaussians:
+        others = sorted(
+            (other for other in gaussians if other != player),
+            key=lambda other: t(player, other),
+        )
+        nearest.update(frozenset((player, other)) for other in others[:3])
+    assert {
+        frozenset(pair) for pair in tstt_sort.candidate_pairs(gaussians, neighbours=3)
+    } == nearest
+    assert tstt_sort.candidate_pairs(gaussians) == pairs
+    for band in (0, 0.5, 0.7, -0.1):
+        with raises(ValueError):
+            tstt_sort.candidate_pairs(gaussians, band=band)
+    assert tstt_sort.candidate_pairs(gaussians, band=0.499)
+
+
+def test__pruned_pairs_are_reported():
+    games, players = _random_games(30, 120, seed=4)
+    league = tstt_sort.TSTTLeague()
+    league.add_players(players)
+    for winner, loser in games:
+        league.add_result(winner, loser)
+    reports = []
+    league.on_prune = lambda pruned, total: reports.append((pruned, total))
+    assert tstt_sort.TSTTLeague().on_prune is None
+    league.recommend_pair()
+    pair = league.recommend_pair(neighbours=4)
+    assert reports[0] == (0, 435)
+    assert 0 < reports[1][0] < 435
+    assert pair == league.recommend_pair(band=0.05)
+
+
+def test__league_is_persisted_and_loaded_lazily(tmp_path, monkeypatch):
+    monkeypatch.setattr(tstt_sort, "LEAGUES_FOLDER", str(tmp_path))
+    games, players = _random_games(10, 30, seed=5)
+    with tstt_sort.TSTTLeague.load("backlog", create=True) as league:
+        league.add_players(players)
+        for winner, loser in games:
+            league.add_result(winner, loser)
+        ranking = league.get_ranked_players()
+        pair = league.recommend_pair()
+
+    loaded = tstt_sort.TSTTLeague.load("backlog")
+    assert loaded.players == set(players) and loaded.matches == league.matches
+    assert loaded.get_ranked_players() == ranking
+    assert loaded.model is None
+    assert loaded.recommend_pair() == pair
+    assert loaded.model is None
+    loaded.add_result(*pair)
+    loaded.get_ranked_players()
+    assert len(loaded.model) == len(games) + 1
+    loaded.save()
+    loaded.close()
+    assert len(tstt_sort.TSTTLeague.load("backlog")._posteriors) == len(players)
+    with raises(FileNotFoundError):
+        tstt_sort.TSTTLeague.load("missing")
+
+
+def test__torn_match_log_is_cut_off(tmp_path, monkeypatch):
+    monkeypatch.setattr(tstt_sort, "LEAGUES_FOLDER", str(tmp_path))
+    league = tstt_sort.TSTTLeague.load("torn", create=True)
+    league.add_players(["a", "b"])
+    league.add_result("a", "b")
+    league.close()
+    with open(tmp_path / "torn.matches", "a") as file:
+        file.write('["b", "a')
+    league = tstt_sort.TSTTLeague.load("torn")
+    assert league.matches == [("a", "b")]
+    # only a writer, under the log lock, cuts the torn line off
+    assert (tmp_path / "torn.matches").read_text().endswith('["b", "a')
+    league.add_result("b", "a")
+    league.close()
+    assert tstt_sort.TSTTLeague.load("torn").matches == [("a", "b"), ("b", "a")]
+    assert (tmp_path / "torn.matches").read_text().endswith('["b", "a"]\n')
+
+
+def test__sorting_a_backlog_again_only_asks_the_new_comparisons(tmp_path, monkeypatch):
+    monkeypatch.setattr(tstt_sort, "LEAGUES_FOLDER", str(tmp_path))
+    players = [f"{number:02}" for number in range(8)]
+    calls = []
+
+    def key(player):
+        calls.append(player)
+        return player
+
+    monkeypatch.setattr(tstt_sort, "LEAGUE_CACHE", {})
+    first = tstt_sort.sorted_tstt(players, "backlog", key=key)
+    asked = len(calls)
+    assert asked
+    monkeypatch.setattr(tstt_sort, "LEAGUE_CACHE", {})
+    assert tstt_sort.sorted_tstt(players, "backlog", key=key) == first
+    assert len(calls) == asked
+    tstt_sort.sorted_tstt(players + ["08"], "backlog", key=key)
+    assert asked < len(calls) < 2 * asked
+
+
+def test__recommended_pairs_are_disjoint_and_best_first():
+    games, players = _random_games(12, 30, seed=6)
+    league = tstt_sort.TSTTLeague()
+    league.add_players(players)
+    for winner, loser in games:
+        league.add_result(winner, loser)
+    pairs = league.recommend_pairs(4)
+    assert len(pairs) == 4
+    assert len({player for pair in pairs for player in pair}) == 8
+    assert pairs[0] == league.recommend_pair()
+    assert len(league.recommend_pairs(10)) == 6
+
+
+def test__batches_compute_keys_concurrently(monkeypatch):
+    import threading
+    import time
+
+    players = [f"{number:02}" for number in range(12)]
+    running, most = [0], [0]
+    lock = threading.Lock()
+
+    def key(player):
+        with lock:
+            running[0] += 1
+            most[0] = max(most[0], running[0])
+        time.sleep(0.01)
+        with lock:
+            running[0] -= 1
+        return player
+
+    played = []
+    recommend_pairs = tstt_sort.TSTTLeague.recommend_pairs
+
+    def spy(league, k=1, *arguments, **keywords):
+        played.append(len(league.matches))
+        return recommend_pairs(league, k, *arguments, **keywords)
+
+    monkeypatch.setattr(tstt_sort.TSTTLeague, "recommend_pairs", spy)
+    ranking = tstt_sort.sorted_tstt(
+        players, key=key, limit=20, batch_size=4, key_workers=4
+    )
+    assert sorted(ranking) == players
+    assert most[0] > 1
+    assert played == [0, 4, 8, 12, 16]
+
+
+def test__sorting_a_changed_backlog_only_compares_and_returns_its_players(
+    tmp_path, monkeypatch
+):
+    monkeypatch.setattr(tstt_sort, "LEAGUES_FOLDER", str(tmp_path))
+    monkeypatch.setattr(tstt_sort, "LEAGUE_CACHE", {})
+    calls = []
+
+    def key(player):
+        calls.append(player)
+        return player
+
+    tstt_sort.sorted_tstt(list("abcdef"), "changed", key=key)
+    calls.clear()
+    ranking = tstt_sort.sorted_tstt(list("ghij"), "changed", key=key)
+    assert sorted(ranking) == list("ghij")
+    assert set(calls) <= set("ghij")
+    calls.clear()
+    ranking = tstt_sort.sorted_tstt(list("abcghi"), "changed", key=key, top=2)
+    assert sorted(ranking) == list("abcghi")
+    assert set(calls) <= set("abcghi")
+
+
+def test__sorted_tstt_passes_the_recommendation_options_on(monkeypatch):
+    players = [f"{number:02}" for number in range(8)]
+    options = []
+    recommend_pairs = tstt_sort.TSTTLeague.recommend_pairs
+
+    def spy(league, k=1, *arguments, **keywords):
+        options.append(arguments)
+        return recommend_pairs(league, k, *arguments, **keywords)
+
+    monkeypatch.setattr(tstt_sort.TSTTLeague, "recommend_pairs", spy)
+    tstt_sort.sorted_tstt(players, key=str, limit=3, band=0.1, neighbours=2)
+    assert options == [(0, None, 0.1, 2)] * 3
+    with raises(ValueError):
+        tstt_sort.sorted_tstt(players, key=str, limit=3, band=0.5)
+
+
+def test__vectorized_evoi_is_the_scalar_one():
+    x = [-9, -3.2, -1, -1e-3, 0, 0.5, 2, 4.7, 9, 27]
+    assert list(tstt_sort._erfcc(x)) == approx([erfc(v) for v in x], rel=2e-7)
+    rng = Random(7)
+    gaussians = [
+        (rng.gauss(0, 5), rng.uniform(0.3, 6), rng.gauss(0, 5), rng.uniform(0.3, 6))
+        for _ in range(200)
+    ] + [(40, 0.5, -40, 0.5)]
+    vectorized = tstt_sort.approximate_evoi_array(*map(np.array, zip(*gaussians)))
+    assert list(vectorized) == approx(
+        [tstt_sort.approximate_evoi(*gaussian) for gaussian in gaussians], rel=1e-6
+    )
+
+
+def test__posterior_table_follows_the_model():
+    games, players = _random_games(15, 40, seed=8)
+    league = tstt_sort.TSTTLeague()
+    league.add_players(players)
+    for winner, loser in games[:30]:
+        league.add_result(winner, loser)
+    league.get_ranked_players()
+    for winner, loser in games[30:]:
+        league.add_result(winner, loser)
+    league.add_players(["newcomer"])
+    ranking = league.get_ranked_players()
+
+    model = league.model
+    posteriors = {
+        player: model.posterior(player) or Gaussian(tstt_sort.MU, tstt_sort.SIGMA)
+        for player in players + ["newcomer"]
+    }
+    for player, posterior in posteriors.items():
+        index = league.ids[player]
+        assert (league.mus[index], league.sigmas[index]) == tuple(posterior)
+    assert ranking == sorted(posteriors, key=lambda player: -posteriors[player].mu)
+    assert league.total_variance() == approx(
+        sum(posterior.sigma**2 for posterior in posteriors.values())
+    )
+    gaussians = league._gaussians()
+    assert league.recommend_pair() == max(
+        combinations(gaussians, 2),
+        key=lambda pair: tstt_sort.approximate_evoi(
+            *gaussians[pair[0]], *gaussians[pair[1]]
+        ),
+    )
+
+    chances = league.win_probabilities(players[:4])
+    assert chances + chances.T == approx(np.ones((4, 4)))
+    left, right = posteriors[players[0]], posteriors[players[1]]
+    assert chances[0, 1] == approx(
+        cdf(
+            0,
+            right.mu - left.mu,
+            sqrt(left.sigma**2 + right.sigma**2 + 2 * tstt_sort.BETA**2),
+        )
+    )
+
+    league._apply_decay()
+    index = league.ids["newcomer"]
+    assert league.mus[index] == tstt_sort.DEFAULT_MU
+    assert league.sigmas[index] == tstt_sort.DEFAULT_SIGMA
+
+
+def test__ranking_confidence_of_adjacent_players():
+    league = tstt_sort.TSTTLeague()
+    league.add_players(["a", "b", "c", "d"])
+    assert league.ranking_confidence() == approx(0.5)
+    for _ in range(6):
+        league.add_result("a", "b")
+        league.add_result("b", "c")
+    league.add_result("c", "d")
+    assert league.get_ranked_players() == ["a", "b", "c", "d"]
+    assert league.ranking_confidence(top=2) > 0.95
+    assert league.ranking_confidence(top=3) < 0.9
+    assert league.ranking_confidence() == league.ranking_confidence(top=3)
+    assert league.ranking_confidence(top=0) == 1.0
+    assert league.recommend_pairs(2, top=1) == [("a", "b")]  # d cannot be second
+    assert ("c", "d") in league.recommend_pairs(2, top=2)
+
+
+def test__sorting_stops_once_confident_or_uninformative():
+    players = list("abcdefgh")
+    calls = []
+
+    def key(player):
+        calls.append(player)
+        return player
+
+    ranking = tstt_sort.sorted_tstt(players, key=key, top=2, confidence=0.75)
+    assert ranking[:2] == ["h", "g"]
+    assert 0 < len(calls) // 2 < ceil(8 * log(8))
+
+    calls.clear()
+    tstt_sort.sorted_tstt(players, key=key, threshold=inf)
+    assert calls == []
+    tstt_sort.sorted_tstt(players, key=key, threshold=inf, minimum=3)
+    assert len(calls) == 6